@@ -0,0 +1,4 @@
+#!/bin/bash
+set -e
+
+python benchmark.py "$@"
\ No newline at end of file
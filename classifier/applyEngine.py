@@ -0,0 +1,167 @@
+"""Summary
+"""
+import joblib
+from classifier import Classifier
+import instrumentation
+import multiprocessing
+import threading
+import logging
+import queue
+
+# Models of the worker processes, loaded once per worker by _initWorker
+_workerModels = {}
+
+def _initWorker(scalePath, labelPath, legalPath, reducePath, probaCertainty, instrumentationSettings):
+	instrumentation.configure(**instrumentationSettings)
+	# Memory-mapped loading: the large arrays of the models are shared
+	# between all workers through the page cache. Copy-on-write, as libsvm
+	# wants writable buffers for dense (reduced) input
+	_workerModels["scaler"] = joblib.load(scalePath, mmap_mode="c")
+	_workerModels["reducer"] = joblib.load(reducePath, mmap_mode="c") if reducePath is not None else None
+	_workerModels["label"] = Classifier.fromModel(joblib.load(labelPath, mmap_mode="c"), "LabelClassifier")
+	_workerModels["legal"] = Classifier.fromModel(joblib.load(legalPath, mmap_mode="c"), "LegalClassifier")
+	_workerModels["probaCertainty"] = probaCertainty
+
+def _scoreBatch(X):
+	with instrumentation.phase("scoreBatch", docs=X.shape[0]) as record:
+		record.update(instrumentation.matrixInfo(X))
+		X = _workerModels["scaler"].transform(X)
+		if _workerModels["reducer"] is not None:
+			X = _workerModels["reducer"].transform(X)
+		labels, labelCertainties = _workerModels["label"].apply(X, _workerModels["probaCertainty"])
+		legals, legalCertainties = _workerModels["legal"].apply(X, _workerModels["probaCertainty"])
+	return labels, legals, labelCertainties, legalCertainties
+
+class ApplyEngine(object):
+	"""Pipelined application of the stored models
+
+	Three stages run concurrently:
+	    - a producer thread prefetching the next batches of vectors
+	    - a pool of worker processes scoring the batches. Every worker loads
+	      the scaler, the optional reducer and both classifiers once
+	    - a writer thread committing the results to the DB
+	Both queues are bounded, so at most a few batches are in memory.
+
+	Attributes:
+	    db (DbConnector): The db connector used for the write back
+	    logger (Logger): The logger
+	    numWorkers (int): Number of scoring processes
+	    prefetch (int): Number of batches fetched ahead
+	"""
+	def __init__(
+		self,
+		db,
+		scalePath,
+		labelPath,
+		legalPath,
+		reducePath=None,
+		numWorkers=1,
+		probaCertainty=True,
+		prefetch=2
+	):
+		"""Summary
+
+		Args:
+		    db (DbConnector): The db connector used for the write back
+		    scalePath (str): Path of the stored scaler
+		    labelPath (str): Path of the stored label model
+		    legalPath (str): Path of the stored legal model
+		    reducePath (str, optional): Path of the stored reducer, None if
+		    							the models were trained unreduced
+		    numWorkers (int, optional): Number of scoring processes
+		    probaCertainty (bool, optional): See Classifier.apply
+		    prefetch (int, optional): Number of batches fetched ahead
+		"""
+		super(ApplyEngine, self).__init__()
+		self.logger = logging.getLogger("classifier.ApplyEngine")
+		self.db = db
+		self.numWorkers = max(1, numWorkers)
+		self.prefetch = max(1, prefetch)
+		self._initArgs = (scalePath, labelPath, legalPath, reducePath, probaCertainty, instrumentation.settings())
+
+	def run(self, batches):
+		"""Score and store all batches
+
+		Args:
+		    batches (iterator): Yields (csr_matrix, Array.<tuple>) pairs, e.g.
+		    					DbConnector.iterLabellingData
+
+		Returns:
+		    int: The number of labelled entries
+		"""
+		# The pool is forked before any thread is started
+		pool = multiprocessing.Pool(
+			processes=self.numWorkers,
+			initializer=_initWorker,
+			initargs=self._initArgs
+		)
+		fetched = queue.Queue(maxsize=self.prefetch)
+		scored = queue.Queue(maxsize=2 * self.numWorkers)
+		errors = []
+		stats = {"labelled": 0}
+		stop = threading.Event()
+		producer = threading.Thread(target=self._produce, args=(batches, fetched, errors, stop))
+		writer = threading.Thread(target=self._write, args=(scored, errors, stats))
+		producer.start()
+		writer.start()
+		try:
+			while True:
+				batch = fetched.get()
+				if batch is None:
+					break
+				X, cleanContents = batch
+				cleanContentIds = [cleanContent.cleanContentId for cleanContent in cleanContents]
+				scored.put((cleanContentIds, pool.apply_async(_scoreBatch, (X,))))
+		finally:
+			stop.set()
+			scored.put(None)
+			writer.join()
+			# Unblock the producer in case it waits for a free slot
+			while producer.is_alive():
+				try:
+					fetched.get(timeout=0.1)
+				except queue.Empty:
+					pass
+			pool.terminate()
+			pool.join()
+		if errors:
+			raise errors[0]
+		return stats["labelled"]
+
+	def _produce(self, batches, fetched, errors, stop):
+		try:
+			for X, cleanContents in batches:
+				if errors or stop.is_set():
+					break
+				if len(cleanContents) > 0:
+					fetched.put((X, cleanContents))
+		except Exception as e:
+			self.logger.exception(str(e))
+			errors.append(e)
+		finally:
+			if not stop.is_set():
+				fetched.put(None)
+
+	def _write(self, scored, errors, stats):
+		while True:
+			entry = scored.get()
+			if entry is None:
+				return
+			if errors:
+				# Drain the queue, so the main thread never blocks
+				continue
+			cleanContentIds, result = entry
+			try:
+				labels, legals, labelCertainties, legalCertainties = result.get()
+				self.db.storeResults(list(zip(
+					cleanContentIds,
+					labels,
+					legals,
+					labelCertainties,
+					legalCertainties
+				)))
+				stats["labelled"] += len(cleanContentIds)
+				self.logger.info("Labelled {count} entries".format(count=stats["labelled"]))
+			except Exception as e:
+				self.logger.exception(str(e))
+				errors.append(e)
@@ -0,0 +1,31 @@
+"""Summary
+"""
+from ast import literal_eval
+
+# Non-numeric gamma values of the scikit-learn SVMs
+GAMMA_KEYWORDS = ("auto", "scale")
+
+def numberOrList(cast, keywords=()):
+	"""Parse a CLI value that is either a number or a list of numbers
+
+	Args:
+	    cast (type): The type of the numbers, e.g. float
+	    keywords (Array.<str>, optional): Strings accepted as they are, e.g.
+	    								  "auto" for gamma
+
+	Returns:
+	    function: The argparse type, e.g. "10" -> 10.0, "[1, 10]" -> [1.0, 10.0]
+	"""
+	def parseEntry(value):
+		if isinstance(value, str) and value in keywords:
+			return value
+		return cast(value)
+
+	def parse(value):
+		if value.strip() in keywords:
+			return value.strip()
+		value = literal_eval(value)
+		if isinstance(value, (list, tuple)):
+			return [parseEntry(entry) for entry in value]
+		return parseEntry(value)
+	return parse
@@ -0,0 +1,444 @@
+"""Benchmarks the classifier on synthetic corpora
+
+For every scale, a throwaway database is created on the configured
+Postgres server and filled with a synthetic corpus (see syntheticCorpus).
+Then the steps of a classifier run are timed one by one: fetching the
+bag-of-words and set-of-words vectors, training, applying, materializing
+the term counts and fetching the vectors again from the materialized
+counts. One JSON line per step is appended to the results file, together
+with the scale, the corpus parameters, the git revision and the library
+versions, so results of different revisions are comparable. The phase
+records of the steps (see instrumentation) go to the same file.
+
+Note: The user needs the CREATEDB privilege. The database is dropped
+afterwards unless --keep is given. As it is dropped, --drop True must be
+passed and its name must start with BENCHMARK_DB_PREFIX.
+"""
+from dotenv import load_dotenv
+from argparse import ArgumentParser
+import joblib
+from sklearn.preprocessing import StandardScaler
+from classifier import Classifier
+from classifier import trainConcurrently
+from dbConnector import DbConnector
+from applyEngine import ApplyEngine
+from syntheticCorpus import generateCorpus
+from modelRegistry import artifactPaths
+from ast import literal_eval
+import instrumentation
+import numpy as np
+import subprocess
+import platform
+import tempfile
+import sklearn
+import scipy
+import psycopg2
+import psycopg2.extensions
+import shutil
+import json
+import os
+import logging
+
+load_dotenv()
+
+logger = logging.getLogger("classifier")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+logger.addHandler(ch)
+
+# Only databases with this prefix are ever dropped by the benchmark
+BENCHMARK_DB_PREFIX = "CLASSIFIER_BENCHMARK"
+
+parser = ArgumentParser()
+parser.add_argument(
+	"--scales",
+	dest="scales",
+	type=str,
+	default=os.environ.get("CLASSIFIER_BENCHMARK_SCALES", "1000,10000"),
+	help="Comma separated numbers of clean contents, one\n\
+benchmark run per scale. Default: 1000,10000\n\
+")
+parser.add_argument(
+	"--database",
+	dest="database",
+	type=str,
+	default=os.environ.get("CLASSIFIER_BENCHMARK_DB", "CLASSIFIER_BENCHMARK"),
+	help="Name of the throwaway database. It is dropped\n\
+and recreated for every scale! Must start with\n\
+CLASSIFIER_BENCHMARK. Default: CLASSIFIER_BENCHMARK\n\
+")
+parser.add_argument(
+	"--drop",
+	dest="drop",
+	type=literal_eval,
+	default=False,
+	help="Confirm that the database given by --database may\n\
+be dropped. Required. Default: False\n\
+")
+parser.add_argument(
+	"--keep",
+	dest="keep",
+	type=literal_eval,
+	default=False,
+	help="Keep the database of the last scale for inspection\n\
+Default: False\n\
+")
+parser.add_argument(
+	"--output",
+	dest="output",
+	type=str,
+	default="./benchmark.jsonl",
+	help="JSON lines file the results are appended to\n\
+Default: ./benchmark.jsonl\n\
+")
+parser.add_argument(
+	"--vocabularySize",
+	dest="vocabularySize",
+	type=int,
+	default=5000,
+	help="Number of terms. Default: 5000\n\
+")
+parser.add_argument(
+	"--docLength",
+	dest="docLength",
+	type=int,
+	default=200,
+	help="Mean number of tokens per document. Default: 200\n\
+")
+parser.add_argument(
+	"--zipf",
+	dest="zipfExponent",
+	type=float,
+	default=1.1,
+	help="Exponent of the Zipf term distribution.\n\
+Default: 1.1\n\
+")
+parser.add_argument(
+	"--topicShare",
+	dest="topicShare",
+	type=float,
+	default=0.3,
+	help="Share of the tokens drawn from the topic of the\n\
+label of a document. Default: 0.3\n\
+")
+parser.add_argument(
+	"--labelSkew",
+	dest="labelSkew",
+	type=float,
+	default=1.0,
+	help="The share of the i-th label is proportional to\n\
+i^-labelSkew, 0 for a balanced mix. Default: 1.0\n\
+")
+parser.add_argument(
+	"--labelledShare",
+	dest="labelledShare",
+	type=float,
+	default=0.5,
+	help="Share of labelled clean contents, the others are\n\
+labelled in the apply step. Default: 0.5\n\
+")
+parser.add_argument(
+	"--seed",
+	dest="seed",
+	type=int,
+	default=42,
+	help="Seed of the corpus generator. Default: 42\n\
+")
+parser.add_argument(
+	"--svmType",
+	dest="svmType",
+	type=str,
+	default="C_SVC",
+	help="The classifier to benchmark, see start.py.\n\
+Default: C_SVC\n\
+")
+parser.add_argument(
+	"--kernelType",
+	dest="kernelType",
+	type=str,
+	default="linear",
+	help="The kernel, see start.py. Default: linear\n\
+")
+parser.add_argument(
+	"--featureMode",
+	dest="featureMode",
+	type=str,
+	default="bow",
+	help="The features used for training and applying,\n\
+see start.py. Default: bow\n\
+")
+parser.add_argument(
+	"--minDocFrequency",
+	dest="minDocFrequency",
+	type=float,
+	default=0.005,
+	help="The df cutoff of the vocabulary, see start.py.\n\
+Default: 0.005\n\
+")
+parser.add_argument(
+	"--batchSize",
+	dest="batchSize",
+	type=int,
+	default=1000,
+	help="Batch size of the apply and materialize steps.\n\
+Default: 1000\n\
+")
+parser.add_argument(
+	"--numThreads",
+	dest="numThreads",
+	type=int,
+	default=1,
+	help="Number of processes for training and applying.\n\
+Default: 1\n\
+")
+args = parser.parse_args()
+
+LABELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "labels.json")
+
+def connectionParams():
+	"""Get the connection parameters of the Postgres server
+
+	Returns:
+	    dict: host, port, user and password as in the classifier env
+	"""
+	return {
+		"host": os.environ["DB_HOST"],
+		"port": os.environ["TDSE_DB_PORT"],
+		"user": os.environ["TDSE_DB_USER"],
+		"password": os.environ["TDSE_DB_PASSWORD"]
+	}
+
+def checkDatabaseName(name):
+	"""Make sure a database is a throwaway benchmark database
+
+	Args:
+	    name (str): The database name
+
+	Raises:
+	    ValueError: If it is the classifier's database (TDSE_DB_NAME) or
+	    			does not start with BENCHMARK_DB_PREFIX
+	"""
+	if name == os.environ.get("TDSE_DB_NAME") or not name.startswith(BENCHMARK_DB_PREFIX):
+		raise ValueError("Refusing to drop database {name}, benchmark databases must start with {prefix}".format(
+			name=name,
+			prefix=BENCHMARK_DB_PREFIX
+		))
+
+def resetDatabase(name, create=True):
+	"""Drop and (re)create the throwaway database
+
+	Args:
+	    name (str): The database name
+	    create (bool, optional): False to only drop it
+	"""
+	checkDatabaseName(name)
+	connection = psycopg2.connect(dbname="postgres", **connectionParams())
+	# CREATE/DROP DATABASE cannot run inside a transaction
+	connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+	cursor = connection.cursor()
+	cursor.execute("DROP DATABASE IF EXISTS \"{name}\"".format(name=name))
+	if create:
+		cursor.execute("CREATE DATABASE \"{name}\"".format(name=name))
+	cursor.close()
+	connection.close()
+
+def labelMix():
+	"""Derive the label mix of the corpus from labels.json
+
+	Every label gets a share following labelSkew and a (seeded, random)
+	probability of being legal, so the legality is learnable from the
+	label topics.
+
+	Returns:
+	    Array.<dict>: {labelId, label, share, legal} per label
+	"""
+	with open(LABELS_PATH) as labelsFile:
+		labels = json.load(labelsFile)["labels"]
+	random = np.random.RandomState(args.seed)
+	legals = random.random_sample(len(labels))
+	return [
+		{
+			"labelId": label["labelId"],
+			"label": label["label"],
+			"share": (rank + 1) ** -args.labelSkew,
+			"legal": float(legal)
+		} for rank, (label, legal) in enumerate(zip(labels, legals))
+	]
+
+def environment():
+	"""Describe the code and platform the benchmark runs on
+
+	Returns:
+	    dict: git revision, python and library versions, cpu count
+	"""
+	try:
+		revision = subprocess.check_output(
+			["git", "rev-parse", "--short", "HEAD"],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL
+		).decode().strip()
+	except Exception:
+		revision = None
+	return {
+		"revision": revision,
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"scipy": scipy.__version__,
+		"sklearn": sklearn.__version__,
+		"cpus": os.cpu_count()
+	}
+
+def fetchTrainingData(db, vocabulary, scale, mode):
+	"""Fetch all labelled clean contents as training matrix
+
+	Args:
+	    db (DbConnector): The db connector
+	    vocabulary (Vocabulary): The feature columns
+	    scale (int): Upper bound of the number of clean contents
+	    mode (str): Either "bow", "sow" or "tfidf"
+
+	Returns:
+	    csr_matrix: The feature matrix
+	    Array.<tuple>: The clean contents
+	"""
+	X, cleanContents, session = db.getTrainingData(
+		limit=scale,
+		quantile=1,
+		mode=mode,
+		vocabulary=vocabulary
+	)
+	session.close()
+	return X, cleanContents
+
+def benchmarkScale(scale, labels, context):
+	"""Generate a corpus of the given scale and time all steps on it
+
+	Args:
+	    scale (int): Number of clean contents
+	    labels (Array.<dict>): The label mix, see labelMix
+	    context (dict): Fields added to every result record
+	"""
+	context = dict(context, scale=scale)
+
+	def step(name):
+		return instrumentation.phase("benchmark", step=name, **context)
+
+	resetDatabase(args.database)
+	with step("generate") as record:
+		connection = psycopg2.connect(dbname=args.database, **connectionParams())
+		record.update(generateCorpus(
+			connection,
+			scale,
+			labels,
+			vocabularySize=args.vocabularySize,
+			docLength=args.docLength,
+			zipfExponent=args.zipfExponent,
+			topicShare=args.topicShare,
+			labelledShare=args.labelledShare,
+			seed=args.seed
+		))
+		record["docs"] = scale
+		connection.close()
+
+	params = connectionParams()
+	db = DbConnector(
+		dbName=args.database,
+		userName=params["user"],
+		host=params["host"],
+		port=params["port"],
+		password=params["password"]
+	)
+	modelDir = tempfile.mkdtemp(prefix="classifierBenchmark")
+	try:
+		with step("vocabulary") as record:
+			vocabulary = db.getVocabulary(args.minDocFrequency)
+			record["vocabularySize"] = len(vocabulary)
+		with step("fetchBow") as record:
+			X, cleanContents = fetchTrainingData(db, vocabulary, scale, "bow")
+			record.update(instrumentation.matrixInfo(X), docs=X.shape[0])
+		with step("fetchSow") as record:
+			X, cleanContents = fetchTrainingData(db, vocabulary, scale, "sow")
+			record.update(instrumentation.matrixInfo(X), docs=X.shape[0])
+		if args.featureMode != "sow":
+			X, cleanContents = fetchTrainingData(db, vocabulary, scale, args.featureMode)
+
+		legalPath, labelPath, scalePath, _, vocabularyPath, idfPath = artifactPaths(modelDir)
+		with step("train") as record:
+			scaler = StandardScaler(with_mean=False)
+			X = scaler.fit_transform(X)
+			labelClf = Classifier.fromParams(svmType=args.svmType, kernelType=args.kernelType, name="LabelClassifier")
+			legalClf = Classifier.fromParams(svmType=args.svmType, kernelType=args.kernelType, name="LegalClassifier")
+			trainConcurrently(
+				[
+					(labelClf, np.array([model.primaryLabelLabelId for model in cleanContents])),
+					(legalClf, np.array([1 if model.legal else 0 for model in cleanContents]))
+				],
+				X,
+				numThreads=args.numThreads
+			)
+			record.update(instrumentation.matrixInfo(X), docs=X.shape[0])
+		joblib.dump(scaler, scalePath)
+		joblib.dump(labelClf.clf, labelPath)
+		joblib.dump(legalClf.clf, legalPath)
+		vocabulary.store(vocabularyPath, idfPath)
+
+		with step("apply") as record:
+			engine = ApplyEngine(
+				db,
+				scalePath,
+				labelPath,
+				legalPath,
+				numWorkers=args.numThreads
+			)
+			record["docs"] = engine.run(db.iterLabellingData(
+				batchSize=args.batchSize,
+				mode=args.featureMode,
+				vocabulary=vocabulary
+			))
+		with step("materialize") as record:
+			record["docs"] = db.materializeTermCounts(batchSize=args.batchSize)
+		with step("fetchBowMaterialized") as record:
+			X, cleanContents = fetchTrainingData(db, vocabulary, scale, "bow")
+			record.update(instrumentation.matrixInfo(X), docs=X.shape[0])
+	finally:
+		shutil.rmtree(modelDir, ignore_errors=True)
+		db.engine.dispose()
+
+def main():
+	checkDatabaseName(args.database)
+	if not args.drop:
+		logger.error("The benchmark drops the database {name}, confirm with --drop True".format(name=args.database))
+		raise SystemExit(-1)
+	instrumentation.configure(metricsPath=args.output)
+	context = dict(
+		environment(),
+		vocabularySize=args.vocabularySize,
+		docLength=args.docLength,
+		zipfExponent=args.zipfExponent,
+		topicShare=args.topicShare,
+		labelSkew=args.labelSkew,
+		labelledShare=args.labelledShare,
+		seed=args.seed,
+		svmType=args.svmType,
+		kernelType=args.kernelType,
+		featureMode=args.featureMode,
+		numThreads=args.numThreads
+	)
+	labels = labelMix()
+	scales = [int(scale) for scale in args.scales.split(",")]
+	for idx, scale in enumerate(scales):
+		logger.info("Benchmarking {scale} clean contents".format(scale=scale))
+		try:
+			benchmarkScale(scale, labels, context)
+		finally:
+			if not (args.keep and idx == len(scales) - 1):
+				resetDatabase(args.database, create=False)
+	logger.info("Results appended to {output}".format(output=args.output))
+
+try:
+	main()
+except Exception as e:
+	logger.exception(str(e))
+	raise SystemExit(-1)
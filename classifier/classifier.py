@@ -1,9 +1,72 @@
 from sklearn import svm
+from sklearn import linear_model
+from sklearn import kernel_approximation
+from sklearn import pipeline
+from sklearn.calibration import CalibratedClassifierCV
 from sklearn.utils import shuffle
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import cross_validate
+from sklearn.model_selection import check_cv
+from sklearn.metrics import get_scorer
+from sklearn.base import clone
+import joblib
+from instrumentation import phase
+import instrumentation
+from instrumentation import matrixInfo
 import numpy as np
 import logging
 
+# The metrics reported by the cross validation in Classifier.train
+SCORINGS = [
+	"accuracy",
+	"f1_micro",
+	"f1_macro",
+	"neg_log_loss",
+	"precision_micro",
+	"precision_macro",
+	"recall_micro",
+	"recall_macro"
+]
+
+# Arrays above this size are passed to the training workers as read-only
+# memory maps instead of being pickled into every worker
+SHARED_MEMORY_THRESHOLD = "1M"
+
+def _linearSVC(cost, tol):
+	return svm.LinearSVC(
+		penalty="l2",
+		loss="squared_hinge",
+		dual=True,
+		tol=tol,
+		C=cost,
+		multi_class="ovr",
+		fit_intercept=True,
+		intercept_scaling=1,
+		verbose=0,
+		random_state=None,
+		max_iter=1000
+	)
+
+def _kernelMap(approximation, gamma, numComponents):
+	if approximation == "nystroem":
+		if gamma == "scale":
+			raise Exception("The Nystroem approximation does not support gamma=\"scale\"")
+		return kernel_approximation.Nystroem(
+			kernel="rbf",
+			# None is the Nystroem equivalent of gamma="auto"
+			gamma=None if gamma == "auto" else gamma,
+			n_components=numComponents,
+			random_state=None
+		)
+	elif approximation == "fourier":
+		if isinstance(gamma, str):
+			raise Exception("Random Fourier features need an explicit (float) gamma")
+		return kernel_approximation.RBFSampler(
+			gamma=gamma,
+			n_components=numComponents,
+			random_state=None
+		)
+	raise Exception("Unknown kernel approximation: {approximation}".format(approximation=approximation))
+
 class Classifier(object):
 	"""docstring for Classifier"""
 	def __init__(self, clf, name="Classifier"):
@@ -32,10 +95,15 @@ class Classifier(object):
 		shrinking=True,
 		probability=False,
 		tol=0.001,
+		alpha=0.0001,
+		approximation=None,
+		numComponents=1000,
 		name="classifier"
 	):
 		clf = None
-		if type(gamma) is not float:
+		# "auto"/"scale" derive gamma from the samples, any other non-float
+		# value means "auto"
+		if not isinstance(gamma, (float, str)):
 			gamma="auto"
 		if svmType == "C_SVC":
 			clf = svm.SVC(
@@ -70,52 +138,260 @@ class Classifier(object):
 				random_state=None
 			)
 		elif svmType == "LinearSVC":
-			clf = svm.LinearSVC(
+			clf = _linearSVC(cost, tol)
+		elif svmType == "SGD":
+			# Linear SVM trained by stochastic gradient descent, supports
+			# out-of-core training through trainIncrementally
+			clf = linear_model.SGDClassifier(
+				loss="hinge",
 				penalty="l2",
-				loss="squared_hinge",
-				dual=True,
-				tol=tol,
-				C=cost,
-				multi_class="ovr",
+				alpha=alpha,
 				fit_intercept=True,
-				intercept_scaling=1,
+				tol=tol,
+				shuffle=True,
 				verbose=0,
 				random_state=None,
-				max_iter=1000
+				learning_rate="optimal",
+				average=False
 			)
 		else:
 			raise Exception("Unknown SVM type: {svmType}".format(svmType=svmType))
+		if approximation is not None:
+			# Explicit map of the RBF kernel in front of a linear model, so
+			# fitting and applying scale linearly with the number of documents
+			if svmType != "SGD":
+				clf = _linearSVC(cost, tol)
+			clf = pipeline.Pipeline([
+				("kernelMap", _kernelMap(approximation, gamma, numComponents)),
+				("clf", clf)
+			])
 		return(cls(clf, name))
 
-	def train(self, datacolumns, targetcolumn):
+	def train(self, datacolumns, targetcolumn, kFold=None, numJobs=1):
+		"""Fit the model and optionally cross validate it
+
+		All metrics are computed from one cross_validate pass, i.e. kFold
+		fits in total, which run in parallel on numJobs processes.
+
+		Args:
+		    datacolumns (csr_matrix): The samples, one per row
+		    targetcolumn (numpy.ndarray): The target class per sample
+		    kFold (int, optional): Number of folds. Cross validation is
+		    					   skipped if undefined or below 2
+		    numJobs (int, optional): Number of parallel cross validation jobs
+
+		Returns:
+		    dict: scoring scheme -> score per fold, empty if no cross
+		    	  validation was done
+		"""
 		self.logger.info("Training...")
-		result = self.clf.fit(datacolumns, targetcolumn)
+		with phase("fit", classifier=self.logger.name, docs=datacolumns.shape[0]) as record:
+			record.update(matrixInfo(datacolumns))
+			result = self.clf.fit(datacolumns, targetcolumn)
 		self.logger.info("Training finished: {output}".format(output=result))
-		for scoring in ["accuracy", "f1_micro", "f1_macro", "neg_log_loss", "precision_micro","precision_macro", "recall_micro", "recall_macro"]:
-			result = cross_val_score(self.clf, datacolumns, targetcolumn, scoring=scoring)
-			self.logger.info("Cross validation {scoringScheme}: {result}".format(scoringScheme=scoring, result=result))
+		if kFold is None or kFold < 2:
+			return {}
+		scorings = list(SCORINGS)
+		if not hasattr(self.clf, "predict_proba"):
+			scorings.remove("neg_log_loss")
+		with phase("crossValidate", classifier=self.logger.name, docs=datacolumns.shape[0], folds=kFold):
+			cvResult = cross_validate(
+				self.clf,
+				datacolumns,
+				targetcolumn,
+				cv=kFold,
+				scoring=scorings,
+				n_jobs=numJobs
+			)
+		results = {}
+		for scoring in scorings:
+			results[scoring] = cvResult["test_" + scoring]
+			self.logger.info("Cross validation {scoringScheme}: {result}".format(
+				scoringScheme=scoring,
+				result=results[scoring]
+			))
+		return results
+
+	def trainIncrementally(self, datacolumns, targetcolumn, classes):
+		"""Update the model with one batch of samples (out-of-core training)
+
+		Only supported by models with partial_fit, e.g. svmType "SGD".
+
+		Args:
+		    datacolumns (csr_matrix): The samples of the batch, one per row
+		    targetcolumn (numpy.ndarray): The target class per sample
+		    classes (numpy.ndarray): All classes that can occur in any batch
+		"""
+		with phase("partialFit", classifier=self.logger.name, docs=datacolumns.shape[0]):
+			datacolumns, targetcolumn = shuffle(datacolumns, targetcolumn)
+			if isinstance(self.clf, pipeline.Pipeline):
+				# The kernel map is fitted on the first batch only
+				kernelMap = self.clf.named_steps["kernelMap"]
+				if not hasattr(kernelMap, "components_") and not hasattr(kernelMap, "random_weights_"):
+					kernelMap.fit(datacolumns)
+				datacolumns = kernelMap.transform(datacolumns)
+				self.clf.named_steps["clf"].partial_fit(datacolumns, targetcolumn, classes=classes)
+			else:
+				self.clf.partial_fit(datacolumns, targetcolumn, classes=classes)
+
+	def calibrate(self, datacolumns, targetcolumn):
+		"""Fit probability estimates on held-out samples
+
+		Wraps the trained model into a sigmoid calibration, afterwards
+		predict_proba is available (e.g. for SGD models).
 
-	def apply(self, datacolumns):
+		Args:
+		    datacolumns (csr_matrix): Held-out samples, one per row
+		    targetcolumn (numpy.ndarray): The target class per sample
+		"""
+		self.logger.info("Held-out accuracy: {score}".format(
+			score=self.clf.score(datacolumns, targetcolumn)
+		))
+		calibrated = CalibratedClassifierCV(self.clf, method="sigmoid", cv="prefit")
+		with phase("calibrate", classifier=self.logger.name, docs=datacolumns.shape[0]):
+			calibrated.fit(datacolumns, targetcolumn)
+		self.clf = calibrated
+
+	def apply(self, datacolumns, useProba=True):
+		"""Classify the given samples
+
+		The decision is always taken on the decision function (argmax for
+		multi-class, sign for binary models). The certainty is either the
+		predict_proba estimate of the chosen class or, if useProba is False
+		or the model offers no probability estimates, derived from the
+		decision scores themselves (logistic function of the margin for
+		binary, softmax over the scores for multi-class models), which
+		avoids the costly predict_proba pass.
+
+		Args:
+		    datacolumns (csr_matrix): The samples, one per row
+		    useProba (bool, optional): Use predict_proba for the certainties
+
+		Returns:
+		    numpy.ndarray: The decided class per sample
+		    numpy.ndarray: The certainty per sample, capped at 0.99
+		"""
 		self.logger.info("Applying...")
+		with phase("apply", classifier=self.logger.name, docs=datacolumns.shape[0]):
+			return self._apply(datacolumns, useProba)
+
+	def _apply(self, datacolumns, useProba):
+		numSamples = datacolumns.shape[0]
+		if numSamples == 0:
+			return self.clf.classes_[:0], np.zeros(0)
+		if not hasattr(self.clf, "decision_function"):
+			# e.g. calibrated models, see calibrate
+			probaScores = self.clf.predict_proba(datacolumns)
+			positions = np.argmax(probaScores, axis=1)
+			certainties = probaScores[np.arange(numSamples), positions]
+			return self.clf.classes_[positions], np.minimum(certainties, 0.99)
 		scores = self.clf.decision_function(datacolumns)
-		probaScores = self.clf.predict_proba(datacolumns)
-		results = []
-		for i in range(0, len(datacolumns)):
-			scoreMax = np.max(scores[i])
-			probaMax = np.max(probaScores[i])
-			try:
-				scorePos = [i for i,x in enumerate(scores[i]) if x == scoreMax][0]
-				scoreDecision = self.clf.classes_[scorePos]
-			except Exception as e:
-				scoreMax = np.max(scores[i])
-				scoreDecision = 0 if scoreMax < 0 else 1
-				scorePos = scoreDecision
-			probaPos = [i for i,x in enumerate(probaScores[i]) if x == probaMax][0]
-			scoreProba = probaScores[i][scorePos]
-			probaDecision = self.clf.classes_[probaPos]
-			# The machine should never reach a human decision certainty - therefor
-			# capping at 99%
-			if scoreProba > 0.99:
-				scoreProba = 0.99
-			results.append((scoreDecision, scoreProba))
-		return results
+		if scores.ndim == 1:
+			positions = (scores >= 0).astype(np.intp)
+		else:
+			positions = np.argmax(scores, axis=1)
+		decisions = self.clf.classes_[positions]
+		if useProba and hasattr(self.clf, "predict_proba"):
+			probaScores = self.clf.predict_proba(datacolumns)
+			certainties = probaScores[np.arange(numSamples), positions]
+		else:
+			certainties = self._scoreCertainty(scores)
+		# The machine should never reach a human decision certainty - therefor
+		# capping at 99%
+		return decisions, np.minimum(certainties, 0.99)
+
+	def _scoreCertainty(self, scores):
+		if scores.ndim == 1:
+			return 1.0 / (1.0 + np.exp(-np.abs(scores)))
+		shifted = np.exp(scores - np.max(scores, axis=1, keepdims=True))
+		return 1.0 / np.sum(shifted, axis=1)
+
+
+def _fitWorker(clf, datacolumns, targetcolumn, train, test, scorings, name, instrumentationSettings):
+	# The worker processes are spawned, not forked
+	instrumentation.configure(**instrumentationSettings)
+	clf = clone(clf)
+	if train is None:
+		with phase("fit", classifier=name, docs=datacolumns.shape[0]) as record:
+			record.update(matrixInfo(datacolumns))
+			return clf.fit(datacolumns, targetcolumn)
+	with phase("crossValidateFold", classifier=name, docs=len(train)):
+		clf.fit(datacolumns[train], targetcolumn[train])
+	return dict(
+		(scoring, get_scorer(scoring)(clf, datacolumns[test], targetcolumn[test]))
+		for scoring in scorings
+	)
+
+def trainConcurrently(jobs, datacolumns, kFold=None, numThreads=1):
+	"""Train several classifiers on the same samples in parallel
+
+	The final fit and every cross validation fold of every classifier are
+	independent fits, all of them run on one pool of numThreads worker
+	processes. The samples are shared with the workers through a
+	memory-mapped file (joblib auto-memmapping) instead of being pickled to
+	each of them.
+
+	Args:
+	    jobs (Array.<tuple>): (Classifier, targetcolumn) pairs
+	    datacolumns (csr_matrix): The samples, one per row
+	    kFold (int, optional): Number of cross validation folds, see
+	    					   Classifier.train
+	    numThreads (int, optional): Total number of worker processes
+
+	Returns:
+	    Array.<dict>: The cross validation results, one per job
+	"""
+	if numThreads <= 1:
+		return [
+			classifier.train(datacolumns, targetcolumn, kFold=kFold, numJobs=numThreads)
+			for classifier, targetcolumn in jobs
+		]
+	# (job index, fold) per task, fold None is the final fit on all samples
+	tasks = []
+	for jobIdx, (classifier, targetcolumn) in enumerate(jobs):
+		classifier.logger.info("Training in worker processes...")
+		tasks.append((jobIdx, None, None, None))
+		if kFold is not None and kFold >= 2:
+			scorings = list(SCORINGS)
+			if not hasattr(classifier.clf, "predict_proba"):
+				scorings.remove("neg_log_loss")
+			# The folds of cross_validate(cv=kFold)
+			folds = check_cv(kFold, targetcolumn, classifier=True).split(datacolumns, targetcolumn)
+			tasks.extend((jobIdx, train, test, scorings) for train, test in folds)
+	with phase("trainConcurrently", classifiers=len(jobs), tasks=len(tasks), docs=datacolumns.shape[0]):
+		outputs = joblib.Parallel(
+			n_jobs=numThreads,
+			max_nbytes=SHARED_MEMORY_THRESHOLD,
+			mmap_mode="r"
+		)(
+			joblib.delayed(_fitWorker)(
+				jobs[jobIdx][0].clf,
+				datacolumns,
+				jobs[jobIdx][1],
+				train,
+				test,
+				scorings,
+				jobs[jobIdx][0].logger.name,
+				instrumentation.settings()
+			)
+			for jobIdx, train, test, scorings in tasks
+		)
+	foldScores = [[] for _ in jobs]
+	for (jobIdx, train, _, _), output in zip(tasks, outputs):
+		if train is None:
+			jobs[jobIdx][0].clf = output
+		else:
+			foldScores[jobIdx].append(output)
+	results = []
+	for (classifier, _), scores in zip(jobs, foldScores):
+		classifier.logger.info("Training finished: {output}".format(output=classifier.clf))
+		cvResults = {}
+		if scores:
+			for scoring in scores[0]:
+				cvResults[scoring] = np.array([score[scoring] for score in scores])
+				classifier.logger.info("Cross validation {scoringScheme}: {result}".format(
+					scoringScheme=scoring,
+					result=cvResults[scoring]
+				))
+		results.append(cvResults)
+	return results
@@ -3,13 +3,109 @@
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
+from sqlalchemy import MetaData
 from sqlalchemy import select
 from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy import tablesample
+from vocabulary import Vocabulary
+from featureCache import FeatureCache
+from instrumentation import phase
+from sqlProfiler import SqlProfiler
+from scipy import sparse
+import numpy as np
 import progressbar
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import select as selectModule
 import statistics
+import json
 import logging
 
+# Number of cleanContentIds sent to the database per batched vector query.
+# Keeps the IN list (and the result set) at a reasonable size while still
+# replacing thousands of round-trips by a handful.
+VECTOR_CHUNK_SIZE = 1000
+
+# The only cleanContents columns the classifier needs. Loading just these
+# keeps the large cleanContent TEXT column out of every sampling query.
+CLASSIFIER_COLUMNS = [
+	"cleanContentId",
+	"legal",
+	"primaryLabelLabelId",
+	"legalCertainty",
+	"labelCertainty",
+	"languageLanguageId",
+	"updatedAt"
+]
+
+# The tables mapped by DbConnector. Only these are reflected - the crawler
+# tables of the same database are never touched by the classifier.
+CLASSIFIER_TABLES = [
+	"cleanContents",
+	"labels",
+	"languages",
+	"terms",
+	"positions",
+	"postingPositions",
+	"postings"
+]
+
+# Applies (cleanContentId, primaryLabelLabelId, legal, labelCertainty,
+# legalCertainty) tuples passed as VALUES list via execute_values
+BULK_UPDATE_QUERY = "\
+UPDATE \"cleanContents\"\n\
+SET\n\
+	\"primaryLabelLabelId\" = results.\"primaryLabelLabelId\",\n\
+	legal = results.legal,\n\
+	\"labelCertainty\" = results.\"labelCertainty\",\n\
+	\"legalCertainty\" = results.\"legalCertainty\"\n\
+FROM (VALUES %s) AS results (\n\
+	\"cleanContentId\",\n\
+	\"primaryLabelLabelId\",\n\
+	legal,\n\
+	\"labelCertainty\",\n\
+	\"legalCertainty\"\n\
+)\n\
+WHERE \"cleanContents\".\"cleanContentId\" = results.\"cleanContentId\"\n\
+RETURNING \"cleanContents\".\"cleanContentId\"\n"
+BULK_UPDATE_TEMPLATE = "(%s::uuid, %s::uuid, %s::boolean, %s::double precision, %s::double precision)"
+
+# Denormalized term counts, see materializeTermCounts. The marker table
+# records every materialized clean content, including those without terms,
+# with the updatedAt of the clean content its counts were taken at.
+CREATE_TERM_COUNTS_QUERY = "\
+CREATE TABLE IF NOT EXISTS \"classifierTermCounts\" (\n\
+	\"cleanContentCleanContentId\" uuid NOT NULL,\n\
+	\"termTermId\" uuid NOT NULL,\n\
+	count integer NOT NULL,\n\
+	PRIMARY KEY (\"cleanContentCleanContentId\", \"termTermId\")\n\
+)\n"
+CREATE_MATERIALIZED_QUERY = "\
+CREATE TABLE IF NOT EXISTS \"classifierMaterialized\" (\n\
+	\"cleanContentCleanContentId\" uuid PRIMARY KEY,\n\
+	\"updatedAt\" timestamptz\n\
+)\n"
+# Marker tables of older versions lack updatedAt, their counts are redone
+MIGRATE_MATERIALIZED_QUERY = "\
+ALTER TABLE \"classifierMaterialized\" ADD COLUMN IF NOT EXISTS \"updatedAt\" timestamptz\n"
+# The given clean contents whose materialized counts are up to date, i.e.
+# taken at their current updatedAt
+CURRENT_MATERIALIZED_QUERY = "\
+SELECT \"classifierMaterialized\".\"cleanContentCleanContentId\"\n\
+FROM\n\
+	\"classifierMaterialized\"\n\
+	INNER JOIN \"cleanContents\" ON \"cleanContents\".\"cleanContentId\"\
+ = \"classifierMaterialized\".\"cleanContentCleanContentId\"\n\
+WHERE\n\
+	\"classifierMaterialized\".\"cleanContentCleanContentId\" IN :cleanContentIds\n\
+	AND \"classifierMaterialized\".\"updatedAt\" = \"cleanContents\".\"updatedAt\"\n"
+
+# Factor by which the TABLESAMPLE percentage exceeds the requested share of
+# the table, compensates for rows dropped by the certainty filter
+SAMPLE_OVERSAMPLING = 2
+
 class DbConnector(object):
 	"""Provides helper functions to access the DB for the ML part
 	
@@ -17,6 +113,8 @@ class DbConnector(object):
 	    Base (TYPE): Description
 	    cleanContents (TYPE): Description
 	    engine (TYPE): Description
+	    featureCache (FeatureCache): The feature cache currently in use
+	    featureCacheDir (str): Root directory of the feature cache
 	    labels (TYPE): Description
 	    languages (TYPE): Description
 	    logger (TYPE): Description
@@ -24,13 +122,14 @@ class DbConnector(object):
 	    postingPositions (TYPE): Description
 	    postings (TYPE): Description
 	    Session (TYPE): Description
+	    sqlProfiler (SqlProfiler): The statement profiler, None if disabled
 	    terms (TYPE): Description
 	
 	Deleted Attributes:
 	    conn (TYPE): Description
 	    connection (TYPE): Description
 	"""
-	def __init__(self, dbName, userName, host, port, password):
+	def __init__(self, dbName, userName, host, port, password, featureCacheDir=None, sqlProfile=False):
 		"""Summary
 		
 		Args:
@@ -39,19 +138,38 @@ class DbConnector(object):
 		    host (TYPE): Description
 		    port (TYPE): Description
 		    password (TYPE): Description
+		    featureCacheDir (str, optional): Directory for the on-disk feature
+		    								 cache. If undefined, every vector
+		    								 is fetched from the DB
+		    sqlProfile (bool, optional): Record the latency of every statement,
+		    							 see SqlProfiler
 		"""
 		super(DbConnector, self).__init__()
 		self.logger = logging.getLogger("classifier.DbConnector")
-		self.Base = automap_base()
-		dbConnectionString = "postgresql+psycopg2://{user}:{pwd}@{host}:{port}/DARKNET_DATA_DUMP".format(
+		self.featureCacheDir = featureCacheDir
+		self.featureCache = None
+		self._featureCacheKey = None
+		self._connectParams = {
+			"dbname": dbName,
+			"user": userName,
+			"host": host,
+			"port": port,
+			"password": password
+		}
+		dbConnectionString = "postgresql+psycopg2://{user}:{pwd}@{host}:{port}/{dbName}".format(
 			user=userName,
 			pwd=password,
 			host=host,
-			port=port
+			port=port,
+			dbName=dbName
 		)
 		self.engine = create_engine(dbConnectionString)
+		self.sqlProfiler = SqlProfiler(self.engine) if sqlProfile else None
 		self.Session = sessionmaker(bind=self.engine)
-		self.Base.prepare(self.engine, reflect=True)
+		metadata = MetaData()
+		metadata.reflect(self.engine, only=CLASSIFIER_TABLES)
+		self.Base = automap_base(metadata=metadata)
+		self.Base.prepare()
 		self.cleanContents = self.Base.classes.cleanContents
 		self.labels = self.Base.classes.labels
 		self.languages = self.Base.classes.languages
@@ -59,6 +177,12 @@ class DbConnector(object):
 		self.positions = self.Base.classes.positions
 		self.postingPositions = self.Base.classes.postingPositions
 		self.postings = self.Base.classes.postings
+		# Engine.has_table was removed in SQLAlchemy 2.0, the dialect's is
+		# available in all versions
+		with self.engine.begin() as connection:
+			self.termCountsMaterialized = self.engine.dialect.has_table(connection, "classifierTermCounts")
+			if self.termCountsMaterialized:
+				connection.execute(text(MIGRATE_MATERIALIZED_QUERY))
 		self.logger.info("Up and running")
 
 	def getLanguage(self, languageString, session=None):
@@ -109,68 +233,647 @@ class DbConnector(object):
 		session.commit()
 		return "", session
 
-	def getBagOfWords(self, cleanContentId, dfCutoff):
+	def getVocabulary(self, dfQuantile, session=None):
+		"""Get the stable term-index vocabulary used as feature columns
+		
+		Args:
+		    dfQuantile (float): Lower bound for the df of every term, relative
+		    					to the number of clean contents
+		    session (Session, optional): An already existing session object for
+		    							 reuse
+		
+		Returns:
+		    Vocabulary: The termIds of all terms with a df above the cutoff,
+		    			with the smoothed IDF log((1 + n) / (1 + df)) + 1
+		"""
+		if session is None:
+			session = self.Session()
+		cleanContentsCount = session.query(self.cleanContents).count()
+		dfCutoff = cleanContentsCount * dfQuantile
+		termIdQuery = text("\
+SELECT terms.\"termId\", terms.\"documentFrequency\"\n\
+FROM terms\n\
+WHERE terms.\"documentFrequency\" > :dfCutoff\n\
+ORDER BY terms.\"termId\" ASC\n")
+		with phase("getVocabulary") as record:
+			terms = session.execute(termIdQuery, {"dfCutoff": dfCutoff}).fetchall()
+			session.commit()
+			record["rows"] = len(terms)
+		documentFrequencies = np.array([term[1] for term in terms], dtype=np.float64)
+		idf = np.log((1 + cleanContentsCount) / (1 + documentFrequencies)) + 1
+		return Vocabulary([term[0] for term in terms], idf)
+
+	def getBagOfWordsBatch(self, cleanContentIds, vocabulary, chunkSize=VECTOR_CHUNK_SIZE):
 		"""
-		Get the bag of words vector from the database
-		for specified clean content. Note: This is slow...
+		Get the bag of words vectors for a whole set of clean contents.
+		Instead of one query per document, the term counts are fetched
+		grouped by (cleanContentCleanContentId, termTermId) for chunks of
+		chunkSize documents and the sparse matrix is assembled client-side.
+		Once the term counts are materialized (see materializeTermCounts),
+		they are read by primary key and only clean contents not
+		materialized yet, or changed since (updatedAt), fall back to the
+		postingPositions join.
 		
 		Args:
-		    cleanContentId (UUIDv4): The clean content id for which the BoW
-		    						 should be built
-		    dfCutoff (int): The cutoff value for how in how many
-		    				docs a term must occure to be considered.
-		    				This is useful, since we need to reduce
-		    				the dimensionality of the vector as well
-		    				as rare terms are mostly misleading.
-		    				Further we try to avoid overfitting with
-		    				such an approach.
+		    cleanContentIds (Array.<UUIDv4>): The clean content ids for which
+		    								   the BoWs should be built
+		    vocabulary (Vocabulary): The feature columns, see getVocabulary
+		    chunkSize (int, optional): Number of documents per query
+		
+		Returns:
+		    csr_matrix: One BoW row per cleanContentId, in the same order as
+		    			cleanContentIds, one column per vocabulary entry
 		"""
-		session = self.Session()
-		queryString = "\
-SELECT COUNT(\"postingPositions\".\"positionId\")\n\
+		countQuery = text("\
+SELECT\n\
+	postings.\"cleanContentCleanContentId\",\n\
+	postings.\"termTermId\",\n\
+	COUNT(\"postingPositions\".\"positionId\")\n\
+FROM\n\
+	postings\n\
+	LEFT OUTER JOIN \"postingPositions\" ON postings.\"postingId\"\
+ = \"postingPositions\".\"postingId\"\n\
+WHERE\n\
+	postings.\"cleanContentCleanContentId\" IN :cleanContentIds\n\
+GROUP BY postings.\"cleanContentCleanContentId\", postings.\"termTermId\"\n")
+		if self.termCountsMaterialized:
+			countQuery = text("\
+SELECT\n\
+	\"classifierTermCounts\".\"cleanContentCleanContentId\",\n\
+	\"classifierTermCounts\".\"termTermId\",\n\
+	\"classifierTermCounts\".count\n\
+FROM\n\
+	\"classifierTermCounts\"\n\
+WHERE\n\
+	\"classifierTermCounts\".\"cleanContentCleanContentId\" IN (\n\
+" + CURRENT_MATERIALIZED_QUERY + "\
+	)\n\
+UNION ALL\n\
+SELECT\n\
+	postings.\"cleanContentCleanContentId\",\n\
+	postings.\"termTermId\",\n\
+	COUNT(\"postingPositions\".\"positionId\")\n\
+FROM\n\
+	postings\n\
+	LEFT OUTER JOIN \"postingPositions\" ON postings.\"postingId\"\
+ = \"postingPositions\".\"postingId\"\n\
+WHERE\n\
+	postings.\"cleanContentCleanContentId\" IN :cleanContentIds\n\
+	AND postings.\"cleanContentCleanContentId\" NOT IN (\n\
+" + CURRENT_MATERIALIZED_QUERY + "\
+	)\n\
+GROUP BY postings.\"cleanContentCleanContentId\", postings.\"termTermId\"\n")
+		return self._fetchTermMatrix(countQuery, cleanContentIds, vocabulary, chunkSize)
+
+	def materializeTermCounts(self, batchSize=VECTOR_CHUNK_SIZE):
+		"""Write the term counts of all new or changed clean contents to classifierTermCounts
+
+		Creates the classifierTermCounts and classifierMaterialized tables if
+		needed. Every call only processes the clean contents missing in
+		classifierMaterialized or whose updatedAt changed since their counts
+		were taken (the preprocessor bumps it when adding postings), i.e.
+		the first run materializes everything and later runs are
+		incremental. The counts of changed clean contents are replaced. Each
+		batch is committed on its own, so an interrupted run loses at most
+		one batch.
+		
+		Args:
+		    batchSize (int, optional): Number of clean contents per transaction
+		
+		Returns:
+		    int: The number of newly materialized clean contents
+		"""
+		# begin() commits on exit, SQLAlchemy 2.0 no longer autocommits DDL
+		with self.engine.begin() as connection:
+			connection.execute(text(CREATE_TERM_COUNTS_QUERY))
+			connection.execute(text(CREATE_MATERIALIZED_QUERY))
+			connection.execute(text(MIGRATE_MATERIALIZED_QUERY))
+		self.termCountsMaterialized = True
+		pendingQuery = text("\
+SELECT \"cleanContents\".\"cleanContentId\", \"cleanContents\".\"updatedAt\"\n\
+FROM \"cleanContents\"\n\
+WHERE\n\
+	\"cleanContents\".\"cleanContentId\" > :lastCleanContentId\n\
+	AND NOT EXISTS (\n\
+		SELECT 1 FROM \"classifierMaterialized\"\n\
+		WHERE \"classifierMaterialized\".\"cleanContentCleanContentId\"\
+ = \"cleanContents\".\"cleanContentId\"\n\
+			AND \"classifierMaterialized\".\"updatedAt\" = \"cleanContents\".\"updatedAt\"\n\
+	)\n\
+ORDER BY \"cleanContents\".\"cleanContentId\" ASC\n\
+LIMIT :batchSize\n")
+		deleteCountsQuery = text("\
+DELETE FROM \"classifierTermCounts\"\n\
+WHERE \"cleanContentCleanContentId\" IN :cleanContentIds\n")
+		insertCountsQuery = text("\
+INSERT INTO \"classifierTermCounts\" (\"cleanContentCleanContentId\", \"termTermId\", count)\n\
+SELECT\n\
+	postings.\"cleanContentCleanContentId\",\n\
+	postings.\"termTermId\",\n\
+	COUNT(\"postingPositions\".\"positionId\")\n\
 FROM\n\
-	(\n\
-		SELECT COUNT(postings.\"termTermId\"), terms.\"termId\"\n\
-		FROM\n\
-			postings\n\
-			RIGHT OUTER JOIN terms ON terms.\"termId\" = \
-			postings.\"termTermId\" AND postings.\"cleanContentCleanContentId\"\
-			 = '{cleanContentId}'\n\
-		WHERE terms.\"documentFrequency\" > {dfCutoff} \n\
-		GROUP BY terms.\"termId\"\n\
-	) boolean\n\
-	LEFT OUTER JOIN postings ON postings.\"termTermId\" = boolean.\"termId\"\
-	 AND postings.\"cleanContentCleanContentId\" =\
-	  '{cleanContentId}'\n\
+	postings\n\
 	LEFT OUTER JOIN \"postingPositions\" ON postings.\"postingId\"\
-	 = \"postingPositions\".\"postingId\"\n\
-GROUP BY boolean.\"termId\"\n\
-ORDER BY boolean.\"termId\" ASC\n".format(
-			cleanContentId=cleanContentId,
-			dfCutoff=dfCutoff
+ = \"postingPositions\".\"postingId\"\n\
+WHERE\n\
+	postings.\"cleanContentCleanContentId\" IN :cleanContentIds\n\
+GROUP BY postings.\"cleanContentCleanContentId\", postings.\"termTermId\"\n\
+ON CONFLICT DO NOTHING\n")
+		insertMarkersQuery = text("\
+INSERT INTO \"classifierMaterialized\" (\"cleanContentCleanContentId\", \"updatedAt\")\n\
+SELECT unnest(CAST(:cleanContentIds AS uuid[])), unnest(CAST(:updatedAts AS timestamptz[]))\n\
+ON CONFLICT (\"cleanContentCleanContentId\") DO UPDATE SET \"updatedAt\" = EXCLUDED.\"updatedAt\"\n")
+		materialized = 0
+		# uuids sort after the nil uuid
+		lastCleanContentId = "00000000-0000-0000-0000-000000000000"
+		while True:
+			session = self.Session()
+			pending = session.execute(pendingQuery, {
+				"lastCleanContentId": lastCleanContentId,
+				"batchSize": batchSize
+			}).fetchall()
+			cleanContentIds = [row[0] for row in pending]
+			if len(cleanContentIds) == 0:
+				session.commit()
+				session.close()
+				break
+			with phase("materialize", docs=len(cleanContentIds)) as record:
+				# Counts of changed clean contents are replaced
+				session.execute(deleteCountsQuery, {"cleanContentIds": tuple(cleanContentIds)})
+				inserted = session.execute(insertCountsQuery, {"cleanContentIds": tuple(cleanContentIds)})
+				record["rows"] = inserted.rowcount
+				session.execute(insertMarkersQuery, {
+					"cleanContentIds": [str(cleanContentId) for cleanContentId in cleanContentIds],
+					"updatedAts": [row[1] for row in pending]
+				})
+				session.commit()
+			session.close()
+			materialized += len(cleanContentIds)
+			lastCleanContentId = cleanContentIds[-1]
+			self.logger.info("Materialized term counts of {count} clean contents".format(count=materialized))
+			if len(cleanContentIds) < batchSize:
+				break
+		return materialized
+
+	def getSetOfWords(self, cleanContentIds, vocabulary, chunkSize=VECTOR_CHUNK_SIZE):
+		"""
+		Get the set of words vectors from the database
+		for specified clean contents.
+		Only the presence of a term matters, so the postings table alone is
+		enough - the postingPositions join of the BoW query is skipped.
+		
+		Args:
+		    cleanContentIds (Array.<UUIDv4>): The clean content ids for which
+		    								   the SoWs should be built
+		    vocabulary (Vocabulary): The feature columns, see getVocabulary
+		    chunkSize (int, optional): Number of documents per query
+		
+		Returns:
+		    csr_matrix: One binary row per cleanContentId, in the same order
+		    			as cleanContentIds, one column per vocabulary entry
+		"""
+		presenceQuery = text("\
+SELECT DISTINCT\n\
+	postings.\"cleanContentCleanContentId\",\n\
+	postings.\"termTermId\",\n\
+	1\n\
+FROM\n\
+	postings\n\
+WHERE\n\
+	postings.\"cleanContentCleanContentId\" IN :cleanContentIds\n")
+		return self._fetchTermMatrix(presenceQuery, cleanContentIds, vocabulary, chunkSize)
+
+	def _fetchTermMatrix(self, query, cleanContentIds, vocabulary, chunkSize):
+		# query yields (cleanContentId, termId, value) for a chunk of ids
+		rowByCleanContentId = {}
+		for idx, cleanContentId in enumerate(cleanContentIds):
+			rowByCleanContentId.setdefault(str(cleanContentId), []).append(idx)
+
+		rows = []
+		termIds = []
+		data = []
+		ids = list(rowByCleanContentId.keys())
+		with phase("fetchVectors", docs=len(ids)) as record:
+			session = self.Session()
+			bar = progressbar.ProgressBar(max_value=len(ids))
+			bar.start()
+			bar.update(0)
+			if len(vocabulary) > 0:
+				for start in range(0, len(ids), chunkSize):
+					chunk = tuple(ids[start:start + chunkSize])
+					queryResult = session.execute(query, {"cleanContentIds": chunk})
+					for cleanContentId, termId, value in queryResult:
+						for row in rowByCleanContentId[str(cleanContentId)]:
+							rows.append(row)
+							termIds.append(termId)
+							data.append(value)
+					bar.update(min(start + chunkSize, len(ids)))
+			bar.finish()
+			session.commit()
+			session.close()
+			record["rows"] = len(data)
+		# Terms outside of the vocabulary are dropped client-side, this keeps
+		# the (potentially huge) termId list out of the query
+		columns = vocabulary.columnsOf(termIds)
+		known = columns >= 0
+		return sparse.csr_matrix(
+			(np.array(data, dtype=np.float64)[known], (np.array(rows, dtype=np.int64)[known], columns[known])),
+			shape=(len(cleanContentIds), len(vocabulary))
+		)
+
+	def getVectors(self, cleanContents, mode, vocabulary, store=True):
+		"""Gather the BoW/SoW/TF-IDF vectors for the given clean contents
+		
+		Args:
+		    cleanContents (Array.<tuple>): The clean contents, each having a
+		    							   cleanContentId and updatedAt
+		    mode (str): Either "bow", "sow" or "tfidf"
+		    vocabulary (Vocabulary): The feature columns
+		    store (bool, optional): See getVectorsById
+		
+		Returns:
+		    csr_matrix: One row per clean content
+		"""
+		cleanContentIds = [cleanContent.cleanContentId for cleanContent in cleanContents]
+		markers = [
+			cleanContent.updatedAt.timestamp() if cleanContent.updatedAt is not None else 0.0
+			for cleanContent in cleanContents
+		]
+		return self.getVectorsById(cleanContentIds, mode, vocabulary, store, markers)
+
+	def getVectorsById(self, cleanContentIds, mode, vocabulary, store=True, markers=None):
+		"""Gather the BoW/SoW/TF-IDF vectors for the given clean content ids
+
+		If a feature cache directory is configured and the markers are given,
+		cached vectors are read from there and only the missing or changed
+		ones are fetched from the DB (and added to the cache afterwards, if
+		store is set). TF-IDF vectors are the BoW vectors weighted by the IDF
+		of the vocabulary.
+		
+		Args:
+		    cleanContentIds (Array.<UUIDv4>): The clean content ids
+		    mode (str): Either "bow", "sow" or "tfidf"
+		    vocabulary (Vocabulary): The feature columns
+		    store (bool, optional): Whether fetched vectors are added to the
+		    						cache. Unlabelled clean contents are only
+		    						read once, by the apply run labelling
+		    						them, so their vectors are not stored
+		    markers (Array.<float>, optional): The updatedAt timestamp per
+		    								   id, see FeatureCache. Without
+		    								   markers the cache is bypassed
+		
+		Returns:
+		    csr_matrix: One row per clean content id
+		"""
+		if mode == "tfidf":
+			return vocabulary.weigh(self.getVectorsById(cleanContentIds, "bow", vocabulary, store, markers))
+		featureCache = self.getFeatureCache(mode, vocabulary)
+		if featureCache is None or markers is None:
+			self.logger.info("Fetching vector data from DB:")
+			return self._fetchVectors(cleanContentIds, mode, vocabulary)
+
+		positions, cached, missing = featureCache.get(cleanContentIds, markers)
+		missingIds = [cleanContentIds[idx] for idx in missing]
+		self.logger.info("Feature cache: {hits} hits, fetching {misses} vectors from DB:".format(
+			hits=len(positions),
+			misses=len(missingIds)
+		))
+		if len(missingIds) > 0:
+			fetched = self._fetchVectors(missingIds, mode, vocabulary)
+			if store:
+				featureCache.put(missingIds, [markers[idx] for idx in missing], fetched)
+		else:
+			fetched = sparse.csr_matrix((0, len(vocabulary)))
+		# Restore the requested row order
+		order = np.empty(len(cleanContentIds), dtype=np.int64)
+		order[positions + missing] = np.arange(len(cleanContentIds))
+		return sparse.vstack([cached, fetched], format="csr")[order]
+
+	def getFeatureCache(self, mode, vocabulary):
+		"""Get the feature cache for the mode/vocabulary combination
+		
+		Args:
+		    mode (str): Either "bow" or "sow"
+		    vocabulary (Vocabulary): The feature columns
+		
+		Returns:
+		    FeatureCache: The cache, None if caching is disabled
+		"""
+		if self.featureCacheDir is None:
+			return None
+		key = (mode, vocabulary.version)
+		if self._featureCacheKey != key:
+			self.featureCache = FeatureCache(self.featureCacheDir, mode, vocabulary)
+			self._featureCacheKey = key
+		return self.featureCache
+
+	def _fetchVectors(self, cleanContentIds, mode, vocabulary):
+		if mode == "bow":
+			return self.getBagOfWordsBatch(cleanContentIds, vocabulary)
+		elif mode == "sow":
+			return self.getSetOfWords(cleanContentIds, vocabulary)
+		self.logger.error("mode {mode} unknown".format(mode=mode))
+		self.logger.error("Supported modes: 'bow', 'sow', 'tfidf'")
+		raise ValueError("Faulty mode {mode}".format(mode=mode))
+
+	def sampleCleanContents(self, condition, limit, languageIds=None, sampling="random", session=None):
+		"""Draw a random sample of clean contents
+
+		Only the CLASSIFIER_COLUMNS are loaded. The sampling strategies are:
+		    random: ORDER BY random() over all matching rows. Exact, but needs
+		    		a scan and sort of the whole table
+		    system: TABLESAMPLE SYSTEM, only reads the sampled pages. The
+		    		rows of a page are correlated (insertion order).
+		    bernoulli: TABLESAMPLE BERNOULLI, samples single rows but still
+		    		   reads every page of the table
+		The percentage is derived from the planner's estimate of the rows
+		passing the filter. If the filter is too selective for a sample to
+		yield enough rows, random is used right away, and if a sample falls
+		short anyway, it is repeated once with random - so the table is
+		scanned at most twice.
+
+		Args:
+		    condition (function): Gets the columns of the sampled table,
+		    					  returns the filter condition
+		    limit (int): Maximal number of entries returned
+		    languageIds (Array.<str>, optional): Restrict to these languages
+		    sampling (str, optional): "random", "system" or "bernoulli"
+		    session (Session, optional): An already existing session object for
+		    							 reuse
+
+		Returns:
+		    Array.<tuple>: The sampled rows (CLASSIFIER_COLUMNS)
+
+		Raises:
+		    ValueError: If the sampling strategy is unknown
+		"""
+		if session is None:
+			session = self.Session()
+		table = self.cleanContents.__table__
+		if sampling == "random":
+			return self._querySample(table, condition, limit, languageIds, session)
+		if sampling == "system":
+			method = func.system
+		elif sampling == "bernoulli":
+			method = func.bernoulli
+		else:
+			self.logger.error("sampling {sampling} unknown".format(sampling=sampling))
+			self.logger.error("Supported sampling strategies: 'random', 'system', 'bernoulli'")
+			raise ValueError("Faulty sampling {sampling}".format(sampling=sampling))
+
+		# The share of the table to sample is limit / (rows * selectivity)
+		estimatedMatches = self._estimateMatches(table, condition, languageIds, session)
+		if not estimatedMatches:
+			percentage = 100.0
+		else:
+			percentage = 100.0 * SAMPLE_OVERSAMPLING * limit / estimatedMatches
+		if percentage < 100.0:
+			rows = self._querySample(
+				tablesample(table, method(percentage)),
+				condition,
+				limit,
+				languageIds,
+				session
+			)
+			if len(rows) >= limit:
+				return rows
+			self.logger.info("Sample of {percentage:.2f}% too small, falling back to random".format(percentage=percentage))
+		return self._querySample(table, condition, limit, languageIds, session)
+
+	def _estimateMatches(self, table, condition, languageIds, session):
+		"""Get the planner's estimate of the rows matching a sample filter
+
+		The estimate is based on the table statistics (reltuples and the
+		column histograms), the table itself is not read. The EXPLAIN runs
+		in a savepoint, so if it fails, the session can still be used for
+		the fallback sample.
+
+		Returns:
+		    float: The estimated number of rows, None if unknown
+		"""
+		query = session.query(table.c.cleanContentId).filter(condition(table.c))
+		languageIds = [languageId for languageId in (languageIds or []) if languageId is not None]
+		if languageIds:
+			query = query.filter(table.c.languageLanguageId.in_(languageIds))
+		statement = query.statement.compile(dialect=self.engine.dialect)
+		savepoint = session.begin_nested()
+		try:
+			# The compiled statement has DBAPI placeholders - run it on the
+			# raw connection of the session (same transaction)
+			cursor = session.connection().connection.cursor()
+			cursor.execute("EXPLAIN (FORMAT JSON) " + str(statement), statement.params)
+			plan = cursor.fetchone()[0]
+			cursor.close()
+			savepoint.commit()
+		except Exception as e:
+			savepoint.rollback()
+			self.logger.warning("Could not estimate the sample size: {error}".format(error=str(e)))
+			return None
+		if isinstance(plan, str):
+			plan = json.loads(plan)
+		return plan[0]["Plan"]["Plan Rows"]
+
+	def _querySample(self, source, condition, limit, languageIds, session):
+		query = session.query(*[source.c[name] for name in CLASSIFIER_COLUMNS]).\
+			filter(condition(source.c))
+		languageIds = [languageId for languageId in (languageIds or []) if languageId is not None]
+		if languageIds:
+			query = query.filter(source.c.languageLanguageId.in_(languageIds))
+		with phase("sample", limit=limit) as record:
+			rows = query.order_by(func.random()).limit(limit).all()
+			record["rows"] = len(rows)
+		return rows
+
+	def iterLabellingData(self, batchSize, mode, vocabulary, languageIds=None, createdAfter=None):
+		"""Stream all not yet labelled clean contents in fixed-size batches
+
+		The clean contents are walked in keyset order by cleanContentId
+		(WHERE "cleanContentId" > last seen id ORDER BY "cleanContentId"
+		LIMIT batchSize), so every batch is a range scan on the primary key,
+		no row is returned twice and the iteration ends after the last
+		unlabelled entry. Each batch uses its own short session, results can
+		be written back between batches without holding a transaction open.
+
+		Args:
+		    batchSize (int): The number of entries per batch
+		    mode (str): Either "bow" or "sow"
+		    vocabulary (Vocabulary): The feature columns
+		    languageIds (Array.<str>, optional): Restrict to these languages
+		    createdAfter (datetime, optional): Only clean contents created
+		    								   after this point in time, see
+		    								   latestCreatedAt
+
+		Yields:
+		    csr_matrix: The feature matrix of the batch
+		    Array.<tuple>: The classifier columns of the clean contents
+		    			   (see CLASSIFIER_COLUMNS), in row order
+		"""
+		def condition(columns):
+			pending = (columns.legalCertainty + columns.labelCertainty)/2 <= 0.1
+			if createdAfter is None:
+				return pending
+			return pending & (columns.createdAt > createdAfter)
+		return self._iterCleanContents(
+			condition,
+			batchSize,
+			mode,
+			vocabulary,
+			languageIds,
+			store=False
 		)
-		queryResult = session.execute(queryString).fetchall()
+
+	def latestCreatedAt(self):
+		"""Creation time of the newest clean content
+
+		Returns:
+		    datetime: The largest createdAt, None if there are no clean
+		    		  contents
+		"""
+		session = self.Session()
+		latest = session.query(func.max(self.cleanContents.__table__.c.createdAt)).scalar()
 		session.commit()
 		session.close()
-		return [i[0] for i in queryResult]
+		return latest
+
+	def iterTrainingData(self, batchSize, quantile, mode, vocabulary, languageIds=None):
+		"""Stream all training data in fixed-size batches
+
+		Same keyset iteration as iterLabellingData, over all clean contents
+		that are certain enough to be used for training. As cleanContentIds
+		are random UUIDs, the batches are in random order with respect to
+		their content.
+
+		Args:
+		    batchSize (int): The number of entries per batch
+		    quantile (float): Specify "how certain" the entry must be in order
+		    				  to be viable
+		    mode (str): Either "bow" or "sow"
+		    vocabulary (Vocabulary): The feature columns
+		    languageIds (Array.<str>, optional): Restrict to these languages
 
-	def getSetOfWords(self, cleanContentId, dfCutoff):
+		Yields:
+		    csr_matrix: The feature matrix of the batch
+		    Array.<tuple>: The classifier columns of the clean contents
+		    			   (see CLASSIFIER_COLUMNS), in row order
 		"""
-		Get the set of words vector from the database
-		for specified clean content. Note: This is slow...
+		return self._iterCleanContents(
+			lambda columns: (columns.legalCertainty + columns.labelCertainty)/2 >= quantile,
+			batchSize,
+			mode,
+			vocabulary,
+			languageIds
+		)
+
+	def _iterCleanContents(self, condition, batchSize, mode, vocabulary, languageIds, store=True):
+		table = self.cleanContents.__table__
+		languageIds = [languageId for languageId in (languageIds or []) if languageId is not None]
+		lastCleanContentId = None
+		while True:
+			session = self.Session()
+			query = session.query(*[table.c[name] for name in CLASSIFIER_COLUMNS]).\
+				filter(condition(table.c))
+			if languageIds:
+				query = query.filter(table.c.languageLanguageId.in_(languageIds))
+			if lastCleanContentId is not None:
+				query = query.filter(table.c.cleanContentId > lastCleanContentId)
+			cleanContents = query.order_by(table.c.cleanContentId).limit(batchSize).all()
+			session.commit()
+			session.close()
+			if len(cleanContents) == 0:
+				return
+			lastCleanContentId = cleanContents[-1].cleanContentId
+			yield self.getVectors(cleanContents, mode, vocabulary, store), cleanContents
+			if len(cleanContents) < batchSize:
+				return
+
+	def listen(self, channel):
+		"""Listen to the notifications the preprocessor sends on the channel
+
+		The listening connection is opened with psycopg2 directly, outside of
+		the engine's pool, so it stays open (and subscribed) until the caller
+		closes it.
+
+		Args:
+		    channel (str): The notification channel
+
+		Returns:
+		    connection: A dedicated psycopg2 connection in autocommit mode,
+		    			see waitForNotify
+		"""
+		connection = psycopg2.connect(**self._connectParams)
+		connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+		cursor = connection.cursor()
+		cursor.execute("LISTEN \"{channel}\"".format(channel=channel))
+		cursor.close()
+		return connection
+
+	def waitForNotify(self, connection, timeout):
+		"""Block until a notification arrives on a listen connection
+
+		Args:
+		    connection (connection): The connection returned by listen
+		    timeout (float): Maximal wait in seconds
+
+		Returns:
+		    bool: True if notified, False on timeout
+		"""
+		if not connection.notifies:
+			if selectModule.select([connection], [], [], timeout) == ([], [], []):
+				return False
+			connection.poll()
+		notified = len(connection.notifies) > 0
+		# Several notifications are handled by one pass over the pending entries
+		del connection.notifies[:]
+		return notified
+
+	def storeResults(self, results, session=None):
+		"""Write classification results back to the cleanContents table
+
+		All results are sent as one VALUES list and applied with a single
+		UPDATE ... FROM, i.e. one round-trip independent of the number of
+		results.
 		
 		Args:
-		    cleanContentId (UUIDv4): The clean content id for which the SoW
-		    						 should be built
-		    dfCutoff (int): The cutoff value for how in how many
-		    				docs a term must occure to be considered.
-		    				This is useful, since we need to reduce
-		    				the dimensionality of the vector as well
-		    				as rare terms are mostly misleading.
-		    				Further we try to avoid overfitting with
-		    				such an approach.
+		    results (Array.<tuple>): (cleanContentId, primaryLabelLabelId,
+		    						 legal, labelCertainty, legalCertainty)
+		    						 tuples
+		    session (Session, optional): An already existing session object for
+		    							 reuse
+		
+		Returns:
+		    Array.<str>: The ids of the updated clean contents
 		"""
-		pass
+		if session is None:
+			session = self.Session()
+		rows = []
+		for cleanContentId, labelId, legal, labelCertainty, legalCertainty in results:
+			rows.append((
+				str(cleanContentId),
+				str(labelId),
+				bool(legal),
+				float(labelCertainty),
+				float(legalCertainty)
+			))
+		with phase("storeResults", docs=len(rows)) as record:
+			updated = self._bulkUpdateCleanContents(rows, session)
+			session.commit()
+			record["rows"] = len(updated)
+		return updated
+
+	def _bulkUpdateCleanContents(self, rows, session):
+		if len(rows) == 0:
+			return []
+		cursor = session.connection().connection.cursor()
+		updated = psycopg2.extras.execute_values(
+			cursor,
+			BULK_UPDATE_QUERY,
+			rows,
+			template=BULK_UPDATE_TEMPLATE,
+			page_size=len(rows),
+			fetch=True
+		)
+		cursor.close()
+		return [str(row[0]) for row in updated]
 
 	def getTrainingData(
 		self,
@@ -179,6 +882,8 @@ ORDER BY boolean.\"termId\" ASC\n".format(
 		mode="bow",
 		dfQuantile=0.005,
 		languageIds=None,
+		vocabulary=None,
+		sampling="random",
 		session=None
 	):
 		"""Get randomized trainings data from the database
@@ -202,53 +907,50 @@ ORDER BY boolean.\"termId\" ASC\n".format(
 									   should be contained in the training
 									   set. If the param is undefined, all
 									   languages are returned.
+			vocabulary (Vocabulary, optional): The feature columns.
+												If undefined, it is derived
+												from dfQuantile
+			sampling (str, optional): The sampling strategy, see
+									  sampleCleanContents
+			session (Session, optional): An already existing session object for
+										 reuse
+
+		Returns:
+			csr_matrix: The feature matrix, one row per clean content
+			Array.<tuple>: The classifier columns of the clean contents
+						   (see CLASSIFIER_COLUMNS), in row order
+			Session: The session used
 		"""
 		if not mode:
 			mode = "bow"
 		if session is None:
 			session = self.Session()
 
-		cleanContentsCount = session.query(self.cleanContents).count()
-		dfCutoff = cleanContentsCount * dfQuantile
+		if vocabulary is None:
+			vocabulary = self.getVocabulary(dfQuantile, session)
 
-		if(languageIds):
-			cleanContents = session.query(self.cleanContents).\
-				filter((self.cleanContents.legalCertainty + self.cleanContents.labelCertainty)/2 >= quantile).\
-				filter(self.cleanContents.languageLanguageId.in_(languageIds)).\
-				order_by(func.random()).\
-				limit(limit).\
-				all()
-		else:
-			cleanContents = session.query(self.cleanContents).\
-				filter((self.cleanContents.legalCertainty + self.cleanContents.labelCertainty)/2 >= quantile).\
-				order_by(func.random()).\
-				limit(limit).\
-				all()
-
-
-		# Gather all BoW/SoWs
-		result = []
-		self.logger.info("Fetching vector data from DB:")
-		bar = progressbar.ProgressBar(max_value=len(cleanContents))
-		bar.start()
-		bar.update(0)
-		for idx, cleanContent in enumerate(cleanContents):
-			if mode == "bow":
-				wordVec = self.getBagOfWords(cleanContent.cleanContentId, dfCutoff)
-			elif mode == "sow":
-				wordVec = self.getSetOfWords(cleanContent.cleanContentId, dfCutoff)
-			else:
-				logger.error("mode {mode} unknown".format(mode=mode))
-				logger.error("Supported modes: 'bow', 'sow'")
-				raise ValueError("Faulty mode {mode}".format(mode=mode))
-			bar.update(idx)
-			result.append((wordVec, cleanContent))
-		bar.finish()
+		cleanContents = self.sampleCleanContents(
+			lambda columns: (columns.legalCertainty + columns.labelCertainty)/2 >= quantile,
+			limit,
+			languageIds,
+			sampling,
+			session
+		)
+		X = self.getVectors(cleanContents, mode, vocabulary)
 		session.commit()
-		return result, session
+		return X, cleanContents, session
 
 
-	def getLabellingData(self, limit, mode, dfQuantile, languageIds, session=None):
+	def getLabellingData(
+		self,
+		limit,
+		mode,
+		dfQuantile,
+		languageIds,
+		vocabulary=None,
+		sampling="random",
+		session=None
+	):
 		"""Get data to apply the model on
 		
 		Args:
@@ -269,56 +971,39 @@ ORDER BY boolean.\"termId\" ASC\n".format(
 		    						   should be contained in the training
 		    						   set. If the param is undefined, all
 		    						   languages are returned.
+		    vocabulary (Vocabulary, optional): The feature columns.
+		    									If undefined, it is derived
+		    									from dfQuantile
+		    sampling (str, optional): The sampling strategy, see
+		    						  sampleCleanContents
 		    session (Session, optional): An already existing session object for
 										 reuse
 		
 		Returns:
-		    Array.<obj>: Contains a cleanContent model and a bag of
-		    			 words vector. The words in the bag of word
-		    			 vector are always sorted alphabetically
+		    csr_matrix: The feature matrix, one row per clean content. The
+		    			columns are sorted by termId
+		    Array.<tuple>: The classifier columns of the clean contents
+		    			   (see CLASSIFIER_COLUMNS), in row order
+		    Session: The session used
 		"""	
 		if not mode:
 			mode = "bow"
 		if session is None:
 			session = self.Session()
 
-		cleanContentsCount = session.query(self.cleanContents).count()
-		dfCutoff = cleanContentsCount * dfQuantile
+		if vocabulary is None:
+			vocabulary = self.getVocabulary(dfQuantile, session)
 
-		if(languageIds):
-			cleanContents = session.query(self.cleanContents).\
-				filter((self.cleanContents.legalCertainty + self.cleanContents.labelCertainty)/2 <= 0.1).\
-				filter(self.cleanContents.languageLanguageId.in_(languageIds)).\
-				order_by(func.random()).\
-				limit(limit).\
-				all()
-		else:
-			cleanContents = session.query(self.cleanContents).\
-				filter((self.cleanContents.legalCertainty + self.cleanContents.labelCertainty)/2 <= 0.1).\
-				order_by(func.random()).\
-				limit(limit).\
-				all()
-
-
-		# Gather all BoW/SoWs
-		result = []
-		bar = progressbar.ProgressBar(max_value=len(cleanContents))
-		bar.start()
-		bar.update(0)
-		for idx, cleanContent in enumerate(cleanContents):
-			if mode == "bow":
-				wordVec = self.getBagOfWords(cleanContent.cleanContentId, dfCutoff)
-			elif mode == "sow":
-				wordVec = self.getSetOfWords(cleanContent.cleanContentId, dfCutoff)
-			else:
-				logger.error("mode {mode} unknown".format(mode=mode))
-				logger.error("Supported modes: 'bow', 'sow'")
-				raise ValueError("Faulty mode {mode}".format(mode=mode))
-			bar.update(idx)
-			result.append((wordVec, cleanContent))
-		bar.finish()
+		cleanContents = self.sampleCleanContents(
+			lambda columns: (columns.legalCertainty + columns.labelCertainty)/2 <= 0.1,
+			limit,
+			languageIds,
+			sampling,
+			session
+		)
+		X = self.getVectors(cleanContents, mode, vocabulary, store=False)
 		session.commit()
-		return result, session
+		return X, cleanContents, session
 
 
 
@@ -0,0 +1,246 @@
+"""Summary
+"""
+from scipy import sparse
+import numpy as np
+import logging
+import shutil
+import math
+import os
+
+# Size-tiered merging: as soon as the MERGE_FACTOR newest segments are of
+# the same size tier (rows in [MERGE_FACTOR^t, MERGE_FACTOR^(t+1))), they
+# are merged into one. Every row is rewritten about log(N)/log(MERGE_FACTOR)
+# times, and a merge only reads the segments it merges.
+MERGE_FACTOR = 4
+# Segments are never merged beyond this size, which bounds the memory and
+# the I/O of a single merge
+MAX_SEGMENT_ROWS = 100000
+
+logger = logging.getLogger("classifier.FeatureCache")
+
+def pruneFeatureCaches(rootDir, keepVersions):
+	"""Remove the feature caches of vocabularies no longer in use
+
+	Args:
+	    rootDir (str): The directory holding all feature caches
+	    keepVersions (Array.<str>): The vocabulary versions to keep, e.g.
+	    							those of the model versions kept by the
+	    							ModelRegistry
+	"""
+	if not os.path.exists(rootDir):
+		return
+	keepVersions = set(keepVersions)
+	for entry in os.listdir(rootDir):
+		if entry.split("-", 1)[-1] not in keepVersions:
+			logger.info("Removing feature cache {entry}".format(entry=entry))
+			shutil.rmtree(os.path.join(rootDir, entry), ignore_errors=True)
+
+class FeatureCache(object):
+	"""On-disk cache of the feature vectors of clean contents
+
+	A vector depends on the feature mode, the vocabulary and the postings of
+	the clean content. The cache is keyed by <mode>-<vocabulary.version>,
+	so every vocabulary gets a cache directory of its own (see
+	pruneFeatureCaches). The preprocessor may add postings to an existing
+	clean content and then bumps its updatedAt, hence every cached row
+	keeps the updatedAt (marker) of the clean content it was fetched for
+	and is only used while the marker is unchanged.
+
+	Every put appends a segment (a CSR matrix plus the cleanContentIds and
+	markers of its rows) stored as plain .npy files, which are
+	memory-mapped on load. A later row of a clean content supersedes the
+	earlier ones, which are dropped on merge. Small segments are merged by
+	size tier, see MERGE_FACTOR.
+
+	Attributes:
+	    directory (str): The directory of this mode/vocabulary combination
+	    logger (Logger): The logger
+	    numColumns (int): The width of the cached vectors
+	    segments (Array.<csr_matrix>): The memory-mapped segments
+	    segmentNames (Array.<str>): The directory names of the segments
+	    segmentMarkers (Array.<numpy.ndarray>): The markers of the rows of
+	    										each segment
+	    locations (dict): cleanContentId -> (segment index, row) of its
+	    				  latest row
+	"""
+	def __init__(self, rootDir, mode, vocabulary):
+		"""Summary
+
+		Args:
+		    rootDir (str): The directory holding all feature caches
+		    mode (str): The feature mode, e.g. "bow"
+		    vocabulary (Vocabulary): The vocabulary the vectors are built for
+		"""
+		super(FeatureCache, self).__init__()
+		self.logger = logging.getLogger("classifier.FeatureCache")
+		key = "{mode}-{version}".format(mode=mode, version=vocabulary.version)
+		self.directory = os.path.join(rootDir, key)
+		self.numColumns = len(vocabulary)
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		self._load()
+
+	def _segmentNames(self):
+		return sorted(
+			entry for entry in os.listdir(self.directory)
+			if entry.startswith("segment-")
+		)
+
+	def _removeLeftovers(self):
+		# Directories of interrupted puts and merges, and segments written
+		# before the rows had markers
+		for entry in os.listdir(self.directory):
+			path = os.path.join(self.directory, entry)
+			if entry.startswith(".tmp-") or entry.startswith(".old-") or \
+				not os.path.exists(os.path.join(path, "markers.npy")):
+				shutil.rmtree(path, ignore_errors=True)
+
+	def _writeSegment(self, name, cleanContentIds, markers, X):
+		tmpPath = os.path.join(self.directory, ".tmp-" + name)
+		shutil.rmtree(tmpPath, ignore_errors=True)
+		os.makedirs(tmpPath)
+		np.save(os.path.join(tmpPath, "ids.npy"), np.array([str(i) for i in cleanContentIds], dtype="U36"))
+		np.save(os.path.join(tmpPath, "markers.npy"), np.asarray(markers, dtype=np.float64))
+		np.save(os.path.join(tmpPath, "data.npy"), X.data)
+		np.save(os.path.join(tmpPath, "indices.npy"), X.indices)
+		np.save(os.path.join(tmpPath, "indptr.npy"), X.indptr)
+		return tmpPath
+
+	def _loadSegment(self, name):
+		path = os.path.join(self.directory, name)
+		ids = np.load(os.path.join(path, "ids.npy"), allow_pickle=False)
+		matrix = sparse.csr_matrix(
+			(
+				np.load(os.path.join(path, "data.npy"), mmap_mode="r"),
+				np.load(os.path.join(path, "indices.npy"), mmap_mode="r"),
+				np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+			),
+			shape=(len(ids), self.numColumns),
+			copy=False
+		)
+		segmentIdx = len(self.segments)
+		self.segments.append(matrix)
+		self.segmentNames.append(name)
+		self.segmentMarkers.append(np.load(os.path.join(path, "markers.npy"), allow_pickle=False))
+		for row, cleanContentId in enumerate(ids):
+			self.locations[str(cleanContentId)] = (segmentIdx, row)
+
+	def _load(self):
+		self.segments = []
+		self.segmentNames = []
+		self.segmentMarkers = []
+		self.locations = {}
+		self._removeLeftovers()
+		for name in self._segmentNames():
+			self._loadSegment(name)
+		self.logger.info("{count} vectors in feature cache {directory}".format(
+			count=len(self.locations),
+			directory=self.directory
+		))
+
+	def __len__(self):
+		return len(self.locations)
+
+	def get(self, cleanContentIds, markers):
+		"""Look up the vectors of the given clean contents
+
+		Rows cached for another marker count as missing.
+
+		Args:
+		    cleanContentIds (Array.<UUIDv4>): The ids to look up
+		    markers (Array.<float>): The current marker per id
+
+		Returns:
+		    Array.<int>: Positions (in cleanContentIds) of the cached vectors
+		    csr_matrix: The cached vectors, in the order of the positions
+		    Array.<int>: Positions of the ids missing in the cache
+		"""
+		rowsBySegment = {}
+		missing = []
+		for idx, (cleanContentId, marker) in enumerate(zip(cleanContentIds, markers)):
+			location = self.locations.get(str(cleanContentId))
+			if location is None or self.segmentMarkers[location[0]][location[1]] != marker:
+				missing.append(idx)
+			else:
+				rowsBySegment.setdefault(location[0], []).append((idx, location[1]))
+		positions = []
+		parts = []
+		for segmentIdx, rows in rowsBySegment.items():
+			positions.extend(idx for idx, _ in rows)
+			parts.append(self.segments[segmentIdx][[row for _, row in rows]])
+		if parts:
+			hits = sparse.vstack(parts, format="csr")
+		else:
+			hits = sparse.csr_matrix((0, self.numColumns))
+		return positions, hits, missing
+
+	def put(self, cleanContentIds, markers, X):
+		"""Append the vectors of new or changed clean contents to the cache
+
+		Args:
+		    cleanContentIds (Array.<UUIDv4>): The ids, one per row of X
+		    markers (Array.<float>): The marker per id, see get
+		    X (csr_matrix): The vectors
+		"""
+		if len(cleanContentIds) == 0:
+			return
+		X = sparse.csr_matrix(X)
+		names = self.segmentNames
+		number = int(names[-1].split("-")[1]) + 1 if names else 0
+		name = "segment-{number:08d}".format(number=number)
+		tmpPath = self._writeSegment(name, cleanContentIds, markers, X)
+		# Readers only ever see complete segments
+		os.rename(tmpPath, os.path.join(self.directory, name))
+		self._loadSegment(name)
+		while self._mergeNewest():
+			pass
+
+	def _mergeNewest(self):
+		"""Merge the MERGE_FACTOR newest segments if they share a size tier
+
+		The merged segment takes the name (i.e. the position) of the oldest
+		merged one, so the segments stay ordered from large to small. Rows
+		superseded by a later row of the same clean content are dropped.
+
+		Returns:
+		    bool: True if segments were merged
+		"""
+		if len(self.segments) < MERGE_FACTOR:
+			return False
+		merged = self.segments[-MERGE_FACTOR:]
+		numRows = sum(matrix.shape[0] for matrix in merged)
+		tiers = set(int(math.log(max(1, matrix.shape[0]), MERGE_FACTOR)) for matrix in merged)
+		if len(tiers) > 1 or numRows > MAX_SEGMENT_ROWS:
+			return False
+		names = self.segmentNames[-MERGE_FACTOR:]
+		firstIdx = len(self.segments) - MERGE_FACTOR
+		ids = []
+		markers = []
+		parts = []
+		for offset, name in enumerate(names):
+			segmentIds = np.load(os.path.join(self.directory, name, "ids.npy"), allow_pickle=False)
+			latest = [
+				row for row, cleanContentId in enumerate(segmentIds)
+				if self.locations[str(cleanContentId)] == (firstIdx + offset, row)
+			]
+			ids.extend(segmentIds[latest])
+			markers.append(self.segmentMarkers[firstIdx + offset][latest])
+			parts.append(merged[offset][latest])
+		tmpPath = self._writeSegment(names[0], ids, np.concatenate(markers), sparse.vstack(parts, format="csr"))
+		oldPath = os.path.join(self.directory, ".old-" + names[0])
+		os.rename(os.path.join(self.directory, names[0]), oldPath)
+		os.rename(tmpPath, os.path.join(self.directory, names[0]))
+		shutil.rmtree(oldPath)
+		for name in names[1:]:
+			shutil.rmtree(os.path.join(self.directory, name))
+		del self.segments[-MERGE_FACTOR:]
+		del self.segmentNames[-MERGE_FACTOR:]
+		del self.segmentMarkers[-MERGE_FACTOR:]
+		self._loadSegment(names[0])
+		return True
+
+	def invalidate(self):
+		"""Drop all cached vectors of this mode/vocabulary"""
+		for name in self._segmentNames():
+			shutil.rmtree(os.path.join(self.directory, name))
+		self._load()
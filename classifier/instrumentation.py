@@ -0,0 +1,152 @@
+"""Summary
+"""
+from contextlib import contextmanager
+import threading
+import datetime
+import resource
+import cProfile
+import logging
+import time
+import json
+import os
+
+logger = logging.getLogger("classifier.Instrumentation")
+
+# Set by configure. Worker processes (the loky workers of joblib and the
+# apply pool) do not share them - every worker entry point calls configure
+# with the settings() of the parent.
+_settings = {
+	"metricsPath": None,
+	"profilePhase": None,
+	"profileDir": None
+}
+_lock = threading.Lock()
+_pageSizeKb = resource.getpagesize() // 1024
+
+def configure(metricsPath=None, profilePhase=None, profileDir=None):
+	"""Enable the phase metrics and/or profiling
+
+	Args:
+	    metricsPath (str, optional): JSON lines file the phase records are
+	    							 appended to, None to disable them
+	    profilePhase (str, optional): Name of a phase to run under cProfile
+	    profileDir (str, optional): Directory of the cProfile dumps
+	"""
+	_settings["metricsPath"] = metricsPath
+	_settings["profilePhase"] = profilePhase
+	_settings["profileDir"] = profileDir
+
+def settings():
+	"""Get the current settings, e.g. to configure spawned workers with
+
+	Returns:
+	    dict: The keyword arguments of configure
+	"""
+	return dict(_settings)
+
+def _currentRss():
+	# Resident set size in kilobytes, None where /proc is not available
+	try:
+		with open("/proc/self/statm") as statm:
+			return int(statm.read().split()[1]) * _pageSizeKb
+	except (IOError, OSError):
+		return None
+
+def _maxRss():
+	# Lifetime peak of the process, kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def matrixInfo(X):
+	"""Describe a feature matrix for a phase record
+
+	Args:
+	    X (csr_matrix): A sparse or dense matrix
+
+	Returns:
+	    dict: shape and nnz of X
+	"""
+	nnz = X.nnz if hasattr(X, "nnz") else int((X != 0).sum())
+	return {"shape": list(X.shape), "nnz": int(nnz)}
+
+@contextmanager
+def phase(name, **info):
+	"""Measure one phase of a run
+
+	Yields a dict the phase can add its figures to, e.g. docs (documents
+	processed, used for docs/sec), rows (DB rows fetched/written) or
+	matrixInfo. On exit, wall time, docs/sec and the memory of the phase are
+	added and the record is appended as one JSON line to the metrics file.
+	The memory figures are in kilobytes: startRss and endRss, rssDelta and
+	peakRss. If the process reached a new peak during the phase, peakRss is
+	exactly that peak, otherwise the phase stayed below an earlier peak and
+	peakRss is max(startRss, endRss). If name is the configured profile
+	phase, the phase runs under cProfile and the stats are dumped to
+	<profileDir>/<name>-<time>-<pid>.prof.
+
+	Args:
+	    name (str): The phase name, e.g. "fetchVectors"
+	    **info: Initial fields of the record
+
+	Yields:
+	    dict: The record of the phase
+	"""
+	record = dict(info)
+	profiler = None
+	if name == _settings["profilePhase"]:
+		profiler = cProfile.Profile()
+		try:
+			profiler.enable()
+		except ValueError:
+			# Another thread is already profiling this phase
+			profiler = None
+	startRss = _currentRss()
+	startMaxRss = _maxRss()
+	start = time.time()
+	try:
+		yield record
+	finally:
+		wallTime = time.time() - start
+		if profiler is not None:
+			profiler.disable()
+			_dumpProfile(name, profiler)
+		if _settings["metricsPath"] is not None:
+			endRss = _currentRss()
+			endMaxRss = _maxRss()
+			if endMaxRss > startMaxRss or startRss is None or endRss is None:
+				peakRss = endMaxRss
+			else:
+				peakRss = max(startRss, endRss)
+			record.update(
+				phase=name,
+				start=datetime.datetime.fromtimestamp(start).isoformat(),
+				wallTime=round(wallTime, 6),
+				pid=os.getpid(),
+				startRss=startRss,
+				endRss=endRss,
+				rssDelta=endRss - startRss if startRss is not None and endRss is not None else None,
+				peakRss=peakRss
+			)
+			if record.get("docs") is not None and wallTime > 0:
+				record["docsPerSec"] = round(record["docs"] / wallTime, 2)
+			_write(record)
+
+def _write(record):
+	line = json.dumps(record, default=str) + "\n"
+	try:
+		with _lock:
+			# One write per line - appends of the worker processes do not
+			# interleave
+			with open(_settings["metricsPath"], "a") as metricsFile:
+				metricsFile.write(line)
+	except Exception as e:
+		logger.warning("Could not write metrics: {error}".format(error=str(e)))
+
+def _dumpProfile(name, profiler):
+	profileDir = _settings["profileDir"] or "."
+	path = os.path.join(profileDir, "{name}-{time}-{pid}.prof".format(
+		name=name,
+		time=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+		pid=os.getpid()
+	))
+	profiler.dump_stats(path)
+	logger.info("Profile of {name} written to {path}".format(name=name, path=path))
@@ -0,0 +1,223 @@
+"""Summary
+"""
+import datetime
+import logging
+import shutil
+import json
+import os
+
+# Number of published versions kept on disk, older ones are removed on
+# publish (the current version is never removed)
+MAX_VERSIONS = 10
+
+def artifactPaths(directory):
+	"""Get the paths of all artifacts of a train run
+	
+	Args:
+	    directory (str): The directory of a model version
+	
+	Returns:
+	    tuple: legal model, label model, scaler, reducer, vocabulary and IDF
+	    	   path
+	"""
+	return (
+		directory + "/legalModel.clf",
+		directory + "/labelModel.clf",
+		directory + "/scaleModel.clf",
+		directory + "/reduceModel.clf",
+		directory + "/vocabulary.npy",
+		directory + "/idf.npy"
+	)
+
+def versionMetadata(directory):
+	"""Read the metadata.json of a model directory
+
+	Args:
+	    directory (str): The directory of a model version
+
+	Returns:
+	    dict: The metadata stored on publish, empty for flat output
+	    	  directories from before the registry
+	"""
+	path = os.path.join(directory, "metadata.json")
+	if not os.path.exists(path):
+		return {}
+	with open(path) as metadataFile:
+		return json.load(metadataFile)
+
+class ModelRegistry(object):
+	"""Versioned storage of the trained artifacts
+
+	Every train run writes its artifacts (scaler, reducer, both classifiers,
+	vocabulary, IDF) into a directory of its own below <root>/versions. Only
+	complete runs are published: the directory is renamed into place, gets a
+	metadata.json and the <root>/current symlink is switched to it
+	atomically. Readers resolve the symlink once, so a concurrent publish
+	never mixes the artifacts of two versions.
+
+	Attributes:
+	    logger (Logger): The logger
+	    rootDir (str): The output directory holding all versions
+	    versionsDir (str): The directory of the versions
+	    currentLink (str): The path of the "current" symlink
+	"""
+	def __init__(self, rootDir):
+		"""Summary
+
+		Args:
+		    rootDir (str): The output directory, e.g. ./outputModels
+		"""
+		super(ModelRegistry, self).__init__()
+		self.logger = logging.getLogger("classifier.ModelRegistry")
+		self.rootDir = rootDir
+		self.versionsDir = os.path.join(rootDir, "versions")
+		self.currentLink = os.path.join(rootDir, "current")
+		if not os.path.exists(self.versionsDir):
+			os.makedirs(self.versionsDir)
+
+	def versions(self):
+		"""Get all published versions
+
+		Returns:
+		    Array.<str>: The versions, oldest first
+		"""
+		return sorted(
+			entry for entry in os.listdir(self.versionsDir)
+			if not entry.startswith(".")
+		)
+
+	def currentVersion(self):
+		"""Get the version the "current" symlink points to
+
+		Returns:
+		    str: The version, None if nothing was published yet
+		"""
+		if not os.path.islink(self.currentLink):
+			return None
+		return os.path.basename(os.readlink(self.currentLink))
+
+	def currentDirectory(self):
+		"""Get the resolved directory of the current version
+
+		Returns:
+		    str: The directory, None if nothing was published yet
+		"""
+		version = self.currentVersion()
+		if version is None:
+			return None
+		return os.path.join(self.versionsDir, version)
+
+	def createVersion(self):
+		"""Create the (unpublished) directory for the artifacts of a new run
+
+		Returns:
+		    str: The directory to store the artifacts in, see publish
+		"""
+		version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+		directory = os.path.join(self.versionsDir, ".tmp-" + version)
+		os.makedirs(directory)
+		return directory
+
+	def publish(self, directory, metadata):
+		"""Publish a directory created by createVersion and make it current
+
+		Args:
+		    directory (str): The directory returned by createVersion
+		    metadata (dict): JSON serializable information on the run
+
+		Returns:
+		    str: The published version
+		"""
+		version = os.path.basename(directory)[len(".tmp-"):]
+		metadata = dict(metadata, version=version)
+		with open(os.path.join(directory, "metadata.json"), "w") as metadataFile:
+			json.dump(metadata, metadataFile, indent=2, sort_keys=True)
+		os.rename(directory, os.path.join(self.versionsDir, version))
+		self.switch(version)
+		self._prune()
+		return version
+
+	def discard(self, directory):
+		"""Remove a directory created by createVersion without publishing it
+
+		Args:
+		    directory (str): The directory returned by createVersion
+		"""
+		self.logger.info("Discarding unpublished model version {directory}".format(directory=directory))
+		shutil.rmtree(directory, ignore_errors=True)
+
+	def switch(self, version):
+		"""Atomically point the "current" symlink to the given version
+
+		Args:
+		    version (str): A published version
+
+		Raises:
+		    ValueError: If the version does not exist
+		"""
+		if version not in self.versions():
+			raise ValueError("Unknown model version {version}".format(version=version))
+		tmpLink = self.currentLink + ".tmp"
+		if os.path.lexists(tmpLink):
+			os.remove(tmpLink)
+		os.symlink(os.path.join("versions", version), tmpLink)
+		# rename(2) replaces the old symlink atomically
+		os.replace(tmpLink, self.currentLink)
+		self.logger.info("Current model version: {version}".format(version=version))
+
+	def rollback(self, version=None):
+		"""Switch back to an older version
+
+		Args:
+		    version (str, optional): The version to switch to. Defaults to the
+		    						 version published before the current one
+
+		Returns:
+		    str: The version switched to
+
+		Raises:
+		    ValueError: If there is no older version
+		"""
+		if version is None:
+			versions = self.versions()
+			current = self.currentVersion()
+			older = [entry for entry in versions if current is None or entry < current]
+			if not older:
+				raise ValueError("No model version older than {current}".format(current=current))
+			version = older[-1]
+		self.switch(version)
+		return version
+
+	def metadata(self, version=None):
+		"""Read the metadata of a version
+
+		Args:
+		    version (str, optional): The version, defaults to the current one
+
+		Returns:
+		    dict: The metadata stored on publish
+		"""
+		version = version if version is not None else self.currentVersion()
+		return versionMetadata(os.path.join(self.versionsDir, version))
+
+	def vocabularyVersions(self):
+		"""Get the vocabulary versions of all published model versions
+
+		Returns:
+		    Array.<str>: The vocabularyVersion of the metadata of every
+		    			 version that has one
+		"""
+		versions = []
+		for version in self.versions():
+			vocabularyVersion = self.metadata(version).get("vocabularyVersion")
+			if vocabularyVersion is not None:
+				versions.append(vocabularyVersion)
+		return versions
+
+	def _prune(self):
+		current = self.currentVersion()
+		versions = self.versions()
+		for version in versions[:max(0, len(versions) - MAX_VERSIONS)]:
+			if version != current:
+				self.logger.info("Removing model version {version}".format(version=version))
+				shutil.rmtree(os.path.join(self.versionsDir, version), ignore_errors=True)
@@ -0,0 +1,48 @@
+"""Summary
+"""
+from sklearn.decomposition import TruncatedSVD
+import numpy as np
+import logging
+
+# Upper bound of the reduced dimensionality, the randomized SVD is fitted
+# with this many components before it is cut down to the retained variance
+MAX_COMPONENTS = 1000
+
+logger = logging.getLogger("classifier.Reducer")
+
+def fitReducer(X, retainedVariance, maxComponents=MAX_COMPONENTS):
+	"""Fit a TruncatedSVD keeping the given share of the variance
+
+	TruncatedSVD works on the sparse (scaled) feature matrix directly. It is
+	fitted with maxComponents components and then truncated to the smallest
+	number of components whose explained variance reaches retainedVariance.
+
+	Args:
+	    X (csr_matrix): The scaled training vectors
+	    retainedVariance (float): Share of the variance to retain, e.g. 0.99
+	    maxComponents (int, optional): Upper bound of the dimensionality
+
+	Returns:
+	    TruncatedSVD: The fitted reducer
+	"""
+	numComponents = max(1, min(maxComponents, min(X.shape) - 1))
+	reducer = TruncatedSVD(n_components=numComponents, algorithm="randomized", random_state=None)
+	reducer.fit(X)
+	explained = np.cumsum(reducer.explained_variance_ratio_)
+	numComponents = min(int(np.searchsorted(explained, retainedVariance)) + 1, numComponents)
+	if explained[-1] < retainedVariance:
+		logger.warning("{count} components retain only {variance:.4f} of the variance".format(
+			count=numComponents,
+			variance=explained[-1]
+		))
+	reducer.components_ = reducer.components_[:numComponents]
+	reducer.explained_variance_ = reducer.explained_variance_[:numComponents]
+	reducer.explained_variance_ratio_ = reducer.explained_variance_ratio_[:numComponents]
+	reducer.singular_values_ = reducer.singular_values_[:numComponents]
+	reducer.n_components = numComponents
+	logger.info("Reduced {width} features to {count} components ({variance:.4f} of the variance)".format(
+		width=X.shape[1],
+		count=numComponents,
+		variance=explained[numComponents - 1]
+	))
+	return reducer
@@ -0,0 +1,152 @@
+"""Summary
+"""
+from sqlalchemy import event
+import threading
+import logging
+import time
+import json
+import re
+
+# Number of statement shapes listed in the log by report
+REPORT_TOP = 10
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"%\([^)]+\)s|%s")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\?(?:, \?)+\)")
+
+def statementShape(statement):
+	"""Normalize a statement, so executions differing only in their
+	parameters (including the length of IN lists) are aggregated
+
+	Args:
+	    statement (str): The SQL sent to the DBAPI cursor
+
+	Returns:
+	    str: The statement with all literals and parameters replaced by ?
+	"""
+	shape = _WHITESPACE.sub(" ", statement).strip()
+	shape = _STRING_LITERAL.sub("?", shape)
+	shape = _PLACEHOLDER.sub("?", shape)
+	shape = _NUMBER.sub("?", shape)
+	return _PLACEHOLDER_LIST.sub("(?)", shape)
+
+class SqlProfiler(object):
+	"""Records latency, row and call counts of every statement of an engine
+
+	Hooks into the before/after_cursor_execute events of the engine, i.e.
+	sees all ORM and text() statements. Statements executed on a raw DBAPI
+	cursor (the execute_values bulk update) bypass the events. Statistics
+	are aggregated by statementShape; the parameters of the slowest
+	execution of every shape are kept, so it can be EXPLAINed afterwards.
+
+	Attributes:
+	    engine (Engine): The profiled engine
+	    logger (Logger): The logger
+	    stats (dict): statement shape -> aggregated statistics
+	"""
+	def __init__(self, engine):
+		"""Summary
+
+		Args:
+		    engine (Engine): The engine to profile
+		"""
+		super(SqlProfiler, self).__init__()
+		self.logger = logging.getLogger("classifier.SqlProfiler")
+		self.engine = engine
+		self.stats = {}
+		self._lock = threading.Lock()
+		event.listen(engine, "before_cursor_execute", self._before)
+		event.listen(engine, "after_cursor_execute", self._after)
+
+	def _before(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault("sqlProfilerStart", []).append(time.time())
+
+	def _after(self, conn, cursor, statement, parameters, context, executemany):
+		duration = time.time() - conn.info["sqlProfilerStart"].pop()
+		rows = max(cursor.rowcount, 0)
+		shape = statementShape(statement)
+		with self._lock:
+			stats = self.stats.get(shape)
+			if stats is None:
+				stats = self.stats[shape] = {
+					"calls": 0,
+					"totalTime": 0.0,
+					"maxTime": 0.0,
+					"rows": 0
+				}
+			stats["calls"] += 1
+			stats["totalTime"] += duration
+			stats["rows"] += rows
+			if duration >= stats["maxTime"]:
+				stats["maxTime"] = duration
+				# executemany parameter lists cannot be EXPLAINed
+				stats["slowest"] = None if executemany else (statement, parameters)
+
+	def explain(self, statement, parameters):
+		"""Run EXPLAIN (ANALYZE, BUFFERS) for a statement
+
+		The statement is actually executed, within a transaction that is
+		rolled back afterwards. The profiler does not record it.
+
+		Args:
+		    statement (str): The DBAPI statement
+		    parameters (dict): Its parameters
+
+		Returns:
+		    Array.<str>: The lines of the query plan
+		"""
+		connection = self.engine.raw_connection()
+		try:
+			cursor = connection.cursor()
+			cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+			plan = [row[0] for row in cursor.fetchall()]
+			cursor.close()
+		finally:
+			connection.rollback()
+			connection.close()
+		return plan
+
+	def report(self, path=None, explainTop=0):
+		"""Log the most expensive statement shapes and optionally store all
+
+		Args:
+		    path (str, optional): JSON file for the complete statistics
+		    explainTop (int, optional): Number of shapes (by maximal latency)
+		    							to EXPLAIN (ANALYZE, BUFFERS)
+
+		Returns:
+		    Array.<dict>: The statistics per shape, by total time descending
+		"""
+		with self._lock:
+			shapes = [
+				dict(
+					(key, value) for key, value in stats.items() if key != "slowest"
+				) for stats in self.stats.values()
+			]
+			for entry, shape in zip(shapes, self.stats.keys()):
+				entry["shape"] = shape
+				entry["meanTime"] = entry["totalTime"] / entry["calls"]
+			slowest = dict((shape, stats.get("slowest")) for shape, stats in self.stats.items())
+		shapes.sort(key=lambda entry: entry["totalTime"], reverse=True)
+		for entry in sorted(shapes, key=lambda entry: entry["maxTime"], reverse=True)[:explainTop]:
+			if slowest[entry["shape"]] is None:
+				continue
+			try:
+				entry["plan"] = self.explain(*slowest[entry["shape"]])
+			except Exception as e:
+				self.logger.warning("Could not explain {shape}: {error}".format(shape=entry["shape"][:80], error=str(e)))
+		for entry in shapes[:REPORT_TOP]:
+			self.logger.info("{calls} calls, {total:.3f}s total, {mean:.4f}s mean, {max:.4f}s max, {rows} rows: {shape}".format(
+				calls=entry["calls"],
+				total=entry["totalTime"],
+				mean=entry["meanTime"],
+				max=entry["maxTime"],
+				rows=entry["rows"],
+				shape=entry["shape"][:200]
+			))
+		if path is not None:
+			with open(path, "w") as reportFile:
+				json.dump(shapes, reportFile, indent=2)
+		return shapes
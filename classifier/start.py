@@ -15,15 +15,20 @@ Attributes:
 """
 from dotenv import load_dotenv
 from argparse import ArgumentParser
-from sklearn.externals import joblib
-from sklearn.preprocessing import StandardScaler
-from classifier import Classifier
 from dbConnector import DbConnector
+from modelRegistry import ModelRegistry
+from modelRegistry import artifactPaths
+from modelRegistry import versionMetadata
+from argumentTypes import numberOrList
+from argumentTypes import GAMMA_KEYWORDS
+from featureCache import pruneFeatureCaches
+import instrumentation
 from ast import literal_eval
-import numpy as np
 import os
 import csv
 import json
+import uuid
+import datetime
 import logging
 
 load_dotenv()
@@ -96,6 +101,59 @@ apply: apply the model to the not yet classified\n\
 entries\n\
 insert: only insert manuall labelled content, do\n\
 nothing else\n\
+materialize: write the term counts of all not yet\n\
+materialized entries to classifierTermCounts, which\n\
+speeds up fetching the bow/tfidf vectors\n\
+rollback: switch the current models back to the\n\
+previous version (or to --modelVersion)\n\
+serve, watch: keep running and label new entries in\n\
+micro-batches as soon as they are preprocessed\n\
+tune: search the best --cost/--nu/--degree/--gamma of\n\
+the given arrays by cross validation and train the\n\
+best label and legal models\n\
+")
+parser.add_argument(
+	"--halving",
+	dest="halving",
+	type=literal_eval,
+	help="Whether tune mode uses successive halving, i.e. drops\n\
+the worse candidates on growing subsamples. Default: False\n\
+")
+parser.add_argument(
+	"--halvingFactor",
+	dest="halvingFactor",
+	type=int,
+	help="Share (1/factor) of the candidates kept per halving round\n\
+Default: 3\n\
+")
+parser.add_argument(
+	"--scoring",
+	dest="scoring",
+	type=str,
+	help="The cross validation score tune mode maximizes, e.g.\n\
+accuracy, f1_macro. Default: f1_macro\n\
+")
+parser.add_argument(
+	"--interval",
+	dest="interval",
+	type=float,
+	help="Seconds between two polls for new entries in serve mode.\n\
+Default: 10\n\
+")
+parser.add_argument(
+	"--notify",
+	dest="notify",
+	type=literal_eval,
+	help="Whether serve mode waits for the notifications the\n\
+preprocessor sends for new clean contents (LISTEN/NOTIFY)\n\
+instead of only polling. Default: False\n\
+")
+parser.add_argument(
+	"--modelVersion",
+	dest="modelVersion",
+	type=str,
+	help="A version below <output_dir>/versions. Apply runs use\n\
+it instead of the current version, rollback switches to it\n\
 ")
 parser.add_argument(
 	"--language",
@@ -128,11 +186,32 @@ parser.add_argument(
 	help="How many entries should be used for training or\n\
 in each labelling step\n\
 ")
+parser.add_argument(
+	"--sampling",
+	dest="sampling",
+	type=str,
+	help="How the random training/labelling sets are drawn:\n\
+random: ORDER BY random() over the whole table (exact)\n\
+system: TABLESAMPLE SYSTEM, only reads the sampled pages (fast)\n\
+bernoulli: TABLESAMPLE BERNOULLI, reads every page\n\
+Selective filters fall back to random. Default: random\n\
+")
+parser.add_argument(
+	"--featureMode",
+	dest="featureMode",
+	type=str,
+	help="The feature vectors of the clean contents:\n\
+bow: term counts (bag of words)\n\
+sow: binary term presence (set of words), cheaper to fetch\n\
+tfidf: term counts weighted by the IDF of terms.documentFrequency\n\
+Train and apply runs have to use the same mode. Default: bow\n\
+")
 parser.add_argument(
 	"--svmType",
 	dest="svmType",
 	type=str,
-	help="Possible values: C_SVC, NU_SVC, LinearSVC\n\
+	help="Possible values: C_SVC, NU_SVC, LinearSVC, SGD\n\
+SGD trains out-of-core on all training data, see --epochs\n\
 ")
 parser.add_argument(
 	"--kernelType",
@@ -140,29 +219,46 @@ parser.add_argument(
 	type=str,
 	help="Possile values: linear, polynomial, rbf, sigmoid\n\
 ")
+parser.add_argument(
+	"--approximation",
+	dest="approximation",
+	type=str,
+	help="Approximate the RBF kernel by an explicit feature map in\n\
+front of a linear model. Possible values: none, nystroem,\n\
+fourier (random Fourier features)\n\
+")
+parser.add_argument(
+	"--components",
+	dest="numComponents",
+	type=int,
+	help="Dimensionality of the approximated kernel feature map\n\
+")
 parser.add_argument(
 	"--cost",
 	dest="cost",
-	type=float,
-	help="Can be a number or an array of numbers\n\
+	type=numberOrList(float),
+	help="Can be a number or an array of numbers, e.g. [1, 10, 100].\n\
+Arrays are only supported by --mode tune\n\
 ")
 parser.add_argument(
 	"--nu",
 	dest="nu",
-	type=float,
+	type=numberOrList(float),
 	help="For NU_SVC or ONE_CLASS. Can be a number or an array of numbers\n\
 ")
 parser.add_argument(
 	"--degree",
 	dest="degree",
-	type=int,
+	type=numberOrList(int),
 	help="For POLY kernel, number or array of numbers\n\
 ")
 parser.add_argument(
 	"--gamma",
 	dest="gamma",
-	type=float,
-	help="For POLY, RBF and SIGMOID\n\
+	type=numberOrList(float, GAMMA_KEYWORDS),
+	help="For POLY, RBF and SIGMOID, number or array of numbers.\n\
+auto (1 / number of features) and scale (also divided by\n\
+the variance of the samples) derive it from the data\n\
 ")
 parser.add_argument(
 	"--rp",
@@ -170,12 +266,37 @@ parser.add_argument(
 	type=float,
 	help="For Poly and SIGMOID\n\
 ")
+parser.add_argument(
+	"--alpha",
+	dest="alpha",
+	type=float,
+	help="Regularization strength for SGD\n\
+")
+parser.add_argument(
+	"--epochs",
+	dest="epochs",
+	type=int,
+	help="Number of passes over the training data for SGD\n\
+")
 parser.add_argument(
 	"--kfold",
 	dest="kFold",
 	type=int,
 	help="Parameter for k-fold cross validation\n"
 )
+parser.add_argument(
+	"--crossValidate",
+	dest="crossValidate",
+	type=literal_eval,
+	help="Whether to cross validate the models after training.\n\
+Default: True\n\
+")
+parser.add_argument(
+	"--numThreads",
+	dest="numThreads",
+	type=int,
+	help="Number of worker processes, e.g. for the cross validation\n\
+")
 parser.add_argument(
 	"--eps",
 	dest="eps",
@@ -201,12 +322,89 @@ parser.add_argument(
 	help="Train model for probability estimates"
 )
 
+parser.add_argument(
+	"--featureCache",
+	dest="featureCache",
+	type=literal_eval,
+	help="Whether to cache the feature vectors on disk\n\
+(in <output_dir>/featureCache). Default: True\n\
+")
+parser.add_argument(
+	"--reduce",
+	dest="reduce",
+	type=literal_eval,
+	help="Whether to reduce the scaled feature vectors with a\n\
+TruncatedSVD before training/applying the classifiers.\n\
+Default: False\n\
+")
+parser.add_argument(
+	"--retainedVariance",
+	dest="retainedVariance",
+	type=float,
+	help="Share of the variance the reduction has to retain.\n\
+Default: 0.99\n\
+")
+parser.add_argument(
+	"--probaCertainty",
+	dest="probaCertainty",
+	type=literal_eval,
+	help="Whether the certainties of applied labels are computed\n\
+with predict_proba (True) or derived from the decision\n\
+scores (False, faster). Default: True\n\
+")
+
+parser.add_argument(
+	"--metrics",
+	dest="metrics",
+	type=literal_eval,
+	help="Whether wall time, throughput, matrix sizes and peak RSS\n\
+of every phase are appended as JSON lines to\n\
+<log_location>/classifier.metrics.jsonl. Default: True\n\
+")
+parser.add_argument(
+	"--profilePhase",
+	dest="profilePhase",
+	type=str,
+	help="Run the given phase (e.g. fetchVectors, fit, apply) under\n\
+cProfile and dump the stats to <log_location>/<phase>-*.prof\n\
+")
+
+parser.add_argument(
+	"--sqlProfile",
+	dest="sqlProfile",
+	type=literal_eval,
+	help="Whether latency, row and call counts of all statements are\n\
+recorded, aggregated by statement shape, and written to\n\
+<log_location>/classifier.sql.json at the end. Default: False\n\
+")
+parser.add_argument(
+	"--sqlExplain",
+	dest="sqlExplain",
+	type=int,
+	help="With --sqlProfile, the number of slowest statement shapes\n\
+to capture EXPLAIN (ANALYZE, BUFFERS) plans for. Default: 0\n\
+")
+
 args = parser.parse_args()
 
+useMetrics = args.metrics if args.metrics is not None else literal_eval(os.environ.get("CLASSIFIER_METRICS", "True"))
+instrumentation.configure(
+	metricsPath=logLocation + "/classifier.metrics.jsonl" if useMetrics else None,
+	profilePhase=args.profilePhase if args.profilePhase is not None else os.environ.get("CLASSIFIER_PROFILE_PHASE"),
+	profileDir=logLocation
+)
+
 ####################################################################
 # Initiate main code run                                           #
 ####################################################################
 
+# Number of csv rows applied per update statement in insert mode
+INSERT_CHUNK_SIZE = 5000
+
+# LISTEN/NOTIFY channel of the serve mode, the preprocessor notifies it
+# (see CLASSIFIER_NOTIFY_CHANNEL in dataPreprocessing/index.js)
+NOTIFY_CHANNEL = "classifier"
+
 def storeModel(path, classifier):
 	"""Summary
 	
@@ -214,6 +412,7 @@ def storeModel(path, classifier):
 	    path (TYPE): Description
 	    classifier (TYPE): Description
 	"""
+	import joblib
 	joblib.dump(classifier, path)
 
 def restoreModel(path, name):
@@ -226,7 +425,9 @@ def restoreModel(path, name):
 	Returns:
 	    TYPE: Description
 	"""
-	model = joblib.load(path)
+	import joblib
+	from classifier import Classifier
+	model = joblib.load(path, mmap_mode="c")
 	return Classifier.fromModel(model, name)
 
 def insertLabels(db):
@@ -243,102 +444,324 @@ def insertLabels(db):
 	insertLabelSession.close()
 
 
+def insertDataset(db, datasetPath, labelIdsByLabel, chunkSize=INSERT_CHUNK_SIZE):
+	"""Import a manually labelled dataset
+
+	The csv file is streamed in chunks of chunkSize rows, every chunk is
+	applied with one set-based update (and committed on its own, so no long
+	transaction is held open). As with row by row updates, the last row of
+	an id wins. Malformed ids and ids that do not exist in the DB are
+	skipped and reported.
+
+	Args:
+	    db (DbConnector): The db connector
+	    datasetPath (str): Path to the cleanContentId;legal;label csv file
+	    labelIdsByLabel (dict): label -> labelId
+	    chunkSize (int, optional): Number of rows per update
+
+	Raises:
+	    SystemExit: If the dataset contains an unknown label
+	"""
+	updatedCount = 0
+	missingIds = []
+	invalidIds = []
+	with open(datasetPath) as datasetFile:
+		reader = csv.DictReader(
+			datasetFile,
+			delimiter=";",
+			quoting=csv.QUOTE_NONE
+		)
+		chunk = []
+		for row in reader:
+			label = row["label"]
+			try:
+				labelId = labelIdsByLabel[label]
+			except Exception as e:
+				logger.exception(str(e))
+				logger.error("Label: " + label)
+				raise SystemExit(-1)
+			try:
+				cleanContentId = str(uuid.UUID(row["cleanContentId"].strip()))
+			except ValueError:
+				invalidIds.append(row["cleanContentId"])
+				continue
+			chunk.append((cleanContentId, labelId, "legal" == row["legal"], 1.0, 1.0))
+			if len(chunk) >= chunkSize:
+				updatedCount += insertChunk(db, chunk, missingIds)
+				chunk = []
+		updatedCount += insertChunk(db, chunk, missingIds)
+	for cleanContentId in invalidIds:
+		logger.warning("Invalid cleanContentId: {cleanContentId}".format(cleanContentId=cleanContentId))
+	for cleanContentId in missingIds:
+		logger.warning("Unknown cleanContentId: {cleanContentId}".format(cleanContentId=cleanContentId))
+	logger.info("Inserted {updated} labelled entries, {missing} ids not found, {invalid} invalid".format(
+		updated=updatedCount,
+		missing=len(missingIds),
+		invalid=len(invalidIds)
+	))
+
+def insertChunk(db, chunk, missingIds):
+	"""Store one chunk of labelled entries
+
+	A single UPDATE ... FROM (VALUES ...) applies an arbitrary one of
+	several rows with the same id, so only the last row per id is sent.
+
+	Args:
+	    db (DbConnector): The db connector
+	    chunk (Array.<tuple>): The rows, see DbConnector.storeResults
+	    missingIds (Array.<str>): Ids not found in the DB are appended here
+
+	Returns:
+	    int: The number of updated entries
+	"""
+	if len(chunk) == 0:
+		return 0
+	chunk = list(dict((row[0], row) for row in chunk).values())
+	updated = set(db.storeResults(chunk))
+	for row in chunk:
+		if row[0] not in updated:
+			missingIds.append(row[0])
+	return len(updated)
+
+def trainOutOfCore(
+	db,
+	classifiers,
+	batchSize,
+	epochs,
+	quantile,
+	vocabulary,
+	languageIds,
+	scalePath,
+	labelPath,
+	legalPath,
+	reducePath=None,
+	retainedVariance=None,
+	featureMode="bow"
+):
+	"""Train the label and legal classifiers on all training data
+
+	The training data is streamed from the DB in batches of batchSize, so
+	the memory usage does not depend on the corpus size. A first pass fits
+	the scaler, followed by epochs passes of incremental training. The
+	first batch is held out and used to calibrate the probability
+	estimates (if there is only one batch, it is used for both). The
+	label classes are the labels seen in the first pass. If a
+	retainedVariance is given, the reducer is fitted on the first batch.
+
+	Args:
+	    db (DbConnector): The db connector
+	    classifiers (Array.<Classifier>): The untrained label and legal
+	    								  classifiers, supporting
+	    								  trainIncrementally
+	    batchSize (int): Number of entries per batch
+	    epochs (int): Number of passes over the training data
+	    quantile (float): Minimal certainty of the training data
+	    vocabulary (Vocabulary): The feature columns
+	    languageIds (Array.<str>): Restrict to these languages
+	    scalePath (str): Where to store the scaler
+	    labelPath (str): Where to store the label model
+	    legalPath (str): Where to store the legal model
+	    reducePath (str, optional): Where to store the reducer
+	    retainedVariance (float, optional): Share of the variance to retain,
+	    									None to skip the reduction
+	    featureMode (str, optional): Either "bow" or "sow"
+
+	Returns:
+	    StandardScaler: The fitted scaler
+	"""
+	from sklearn.preprocessing import StandardScaler
+	from reducer import fitReducer
+	import numpy as np
+	labelClf, legalClf = classifiers
+
+	def targets(cleanContents):
+		Y_label = np.array([str(model.primaryLabelLabelId) for model in cleanContents])
+		Y_legal = np.array([1 if model.legal else 0 for model in cleanContents])
+		return Y_label, Y_legal
+
+	scaler = StandardScaler(with_mean=False)
+	numBatches = 0
+	labelIds = set()
+	firstBatch = None
+	for X, cleanContents in db.iterTrainingData(batchSize, quantile, featureMode, vocabulary, languageIds):
+		if firstBatch is None:
+			firstBatch = X
+		with instrumentation.phase("scale", docs=X.shape[0]) as record:
+			record.update(instrumentation.matrixInfo(X))
+			scaler.partial_fit(X)
+		labelIds.update(targets(cleanContents)[0])
+		numBatches += 1
+	if numBatches == 0:
+		raise ValueError("No training data available")
+	# partial_fit needs all classes up front
+	labelClasses = np.array(sorted(labelIds))
+	legalClasses = np.array([0, 1])
+	storeModel(scalePath, scaler)
+	reducer = None
+	if retainedVariance is not None:
+		reducer = fitReducer(scaler.transform(firstBatch), retainedVariance)
+		storeModel(reducePath, reducer)
+
+	heldOut = None
+	for epoch in range(epochs):
+		logger.info("Epoch {epoch}/{epochs}".format(epoch=epoch + 1, epochs=epochs))
+		for idx, (X, cleanContents) in enumerate(db.iterTrainingData(batchSize, quantile, featureMode, vocabulary, languageIds)):
+			X = scaler.transform(X)
+			if reducer is not None:
+				X = reducer.transform(X)
+			Y_label, Y_legal = targets(cleanContents)
+			if idx == 0 and heldOut is None:
+				heldOut = (X, Y_label, Y_legal)
+			if idx == 0 and numBatches > 1:
+				continue
+			labelClf.trainIncrementally(X, Y_label, labelClasses)
+			legalClf.trainIncrementally(X, Y_legal, legalClasses)
+
+	X, Y_label, Y_legal = heldOut
+	labelClf.calibrate(X, Y_label)
+	legalClf.calibrate(X, Y_legal)
+	storeModel(labelPath, labelClf.clf)
+	storeModel(legalPath, legalClf.clf)
+	return scaler
+
 def run():
 	"""Run the classification process 
 	
 	Raises:
 	    SystemExit: Description
 	"""
-	legalPath = args.outputDir + "/legalModel.clf"
-	labelPath = args.outputDir + "/labelModel.clf"
-	scalePath = args.outputDir + "/scaleModel.clf"
+	registry = ModelRegistry(args.outputDir)
+	if args.modelVersion is not None and args.mode != "rollback":
+		modelDir = os.path.join(registry.versionsDir, args.modelVersion)
+	else:
+		# Output directories from before the registry keep their flat layout
+		modelDir = registry.currentDirectory() or args.outputDir
+	legalPath, labelPath, scalePath, reducePath, vocabularyPath, idfPath = artifactPaths(modelDir)
 
 	svmType = args.svmType if args.svmType is not None else os.environ["CLASSIFIER_SVM_TYPE"]
 	kernelType = args.kernelType if args.kernelType is not None else os.environ["CLASSIFIER_KERNEL_TYPE"]
-	cost = args.cost if args.cost is not None else literal_eval(os.environ["CLASSIFIER_COST"])
-	nu = args.nu if args.nu is not None else literal_eval(os.environ["CLASSIFIER_NU"])
-	degree = args.degree if args.degree is not None else literal_eval(os.environ["CLASSIFIER_DEGREE"])
-	gamma = args.gamma if args.gamma is not None else literal_eval(os.environ["CLASSIFIER_GAMMA"])
+	cost = args.cost if args.cost is not None else numberOrList(float)(os.environ["CLASSIFIER_COST"])
+	nu = args.nu if args.nu is not None else numberOrList(float)(os.environ["CLASSIFIER_NU"])
+	degree = args.degree if args.degree is not None else numberOrList(int)(os.environ["CLASSIFIER_DEGREE"])
+	gamma = args.gamma if args.gamma is not None else numberOrList(float, GAMMA_KEYWORDS)(os.environ["CLASSIFIER_GAMMA"])
 	rValue = args.rValue if args.rValue is not None else literal_eval(os.environ["CLASSIFIER_R"])
 	kFold = args.kFold if args.kFold is not None else literal_eval(os.environ["CLASSIFIER_KFOLD"])
 	cacheSize = args.cacheSize if args.cacheSize is not None else literal_eval(os.environ["CLASSIFIER_CACHE_SIZE"])
 	shrinking = args.shrinking if args.shrinking is not None else literal_eval(os.environ["CLASSIFIER_SHRINKING"])
 	probability = args.probability if args.probability is not None else literal_eval(os.environ["CLASSIFIER_PROBABILITY"])
 	tol = args.eps if args.eps is not None else literal_eval(os.environ["CLASSIFIER_EPS"])
+	alpha = args.alpha if args.alpha is not None else literal_eval(os.environ.get("CLASSIFIER_ALPHA", "0.0001"))
+	approximation = args.approximation if args.approximation is not None else os.environ.get("CLASSIFIER_APPROXIMATION", "none")
+	approximation = None if approximation == "none" else approximation
+	numComponents = args.numComponents if args.numComponents is not None else literal_eval(os.environ.get("CLASSIFIER_COMPONENTS", "1000"))
+	epochs = args.epochs if args.epochs is not None else literal_eval(os.environ.get("CLASSIFIER_EPOCHS", "5"))
+	# The candidates of tune mode, all other modes take single values
+	tuneGrid = dict(
+		(name, list(value) if isinstance(value, (list, tuple)) else [value])
+		for name, value in (("cost", cost), ("nu", nu), ("degree", degree), ("gamma", gamma))
+	)
+	if args.mode != "tune" and any(len(values) > 1 for values in tuneGrid.values()):
+		logger.error("Arrays of --cost/--nu/--degree/--gamma are only supported by --mode tune")
+		raise SystemExit(-1)
+	cost, nu, degree, gamma = [tuneGrid[name][0] for name in ("cost", "nu", "degree", "gamma")]
+	classifierParams = {
+		"svmType": svmType,
+		"kernelType": kernelType,
+		"cost": cost,
+		"nu": nu,
+		"degree": degree,
+		"gamma": gamma,
+		"rValue": rValue,
+		"kFold": kFold,
+		"cacheSize": cacheSize,
+		"shrinking": shrinking,
+		"probability": probability,
+		"tol": tol,
+		"alpha": alpha,
+		"approximation": approximation,
+		"numComponents": numComponents
+	}
+	crossValidate = args.crossValidate if args.crossValidate is not None else literal_eval(os.environ.get("CLASSIFIER_CROSS_VALIDATE", "True"))
+	numThreads = args.numThreads if args.numThreads is not None else literal_eval(os.environ.get("CLASSIFIER_NUM_THREADS", "1"))
+	probaCertainty = args.probaCertainty if args.probaCertainty is not None else literal_eval(os.environ.get("CLASSIFIER_PROBA_CERTAINTY", "True"))
+	reduce = args.reduce if args.reduce is not None else literal_eval(os.environ.get("CLASSIFIER_REDUCE", "False"))
+	retainedVariance = args.retainedVariance if args.retainedVariance is not None else literal_eval(os.environ.get("CLASSIFIER_RETAINED_VARIANCE", "0.99"))
+	sqlProfile = args.sqlProfile if args.sqlProfile is not None else literal_eval(os.environ.get("CLASSIFIER_SQL_PROFILE", "False"))
+	sqlExplain = args.sqlExplain if args.sqlExplain is not None else literal_eval(os.environ.get("CLASSIFIER_SQL_EXPLAIN", "0"))
+	useFeatureCache = args.featureCache if args.featureCache is not None else literal_eval(os.environ.get("CLASSIFIER_FEATURE_CACHE", "True"))
 
-	labelClfTrained = False
-	legalClfTrained = False
-	scaleModelTrained = False
-	try:
-		labelClf = restoreModel(labelPath, "LabelClassifier")
-		labelClfTrained = True
-	except Exception as e:
-		logger.warning(str(e))
-		logger.warning("Cannot restore previous label classifier - creating new one")
-		try:
-			labelClf = Classifier.fromParams(
-				svmType=svmType,
-				kernelType=kernelType,
-				cost=cost,
-				nu=nu,
-				degree=degree,
-				gamma=gamma,
-				rValue=rValue,
-				kFold=kFold,
-				cacheSize=cacheSize,
-				shrinking=shrinking,
-				probability=probability,
-				tol=tol,
-				name="LabelClassifier"
-			)
-		except Exception as e:
-			logger.exception(str(e))
-			logger.error("Could not create label classifier instance")
+	mode = args.mode;
+	if not mode:
+		if args.datasetPath:
+			mode = "train"
+		elif os.path.exists(labelPath) and os.path.exists(legalPath):
+			mode = "apply"
+		else:
+			logger.error("Cannot apply empty models. Please train first")
 			raise SystemExit(-1)
 
-	try:
-		legalClf = restoreModel(legalPath, "LegalClassifier")
-		legalClfTrained = True
-	except Exception as e:
-		logger.warning(str(e))
-		logger.warning("Cannot restore previous label classifier - creating new one")
-		try:
-			legalClf = Classifier.fromParams(
-				svmType=svmType,
-				kernelType=kernelType,
-				cost=cost,
-				nu=nu,
-				degree=degree,
-				gamma=gamma,
-				rValue=rValue,
-				kFold=kFold,
-				cacheSize=cacheSize,
-				shrinking=shrinking,
-				probability=probability,
-				tol=tol,
-				name="LegalClassifier"
-			)
-		except Exception as e:
-			logger.exception(str(e))
-			logger.error("Could not creat legal classifier instance")
-			raise SystemExit(-1)
-	try:
-		scaler = joblib.load(scalePath)
-		scaleModelTrained = True
-	except Exception as e:
-		try:
-			scaler = StandardScaler()
-		except Exception as e:
-			logger.exception(str(e))
-			logger.error("could not create scaler - giving up")
+	if mode == "rollback":
+		# Only switches a symlink - no models, no DB needed
+		version = registry.rollback(args.modelVersion)
+		logger.info("Rolled back to model version {version}".format(version=version))
+		return
+
+	# Only these modes use the models in this process - all others start
+	# without importing scikit-learn
+	if mode in ("train", "tune", "apply"):
+		import joblib
+		from sklearn.preprocessing import StandardScaler
+		from classifier import Classifier
+		if mode == "apply":
+			labelClfTrained = False
+			legalClfTrained = False
+			scaleModelTrained = False
+			try:
+				labelClf = restoreModel(labelPath, "LabelClassifier")
+				labelClfTrained = True
+			except Exception as e:
+				logger.warning(str(e))
+				logger.warning("Cannot restore previous label classifier")
+			try:
+				legalClf = restoreModel(legalPath, "LegalClassifier")
+				legalClfTrained = True
+			except Exception as e:
+				logger.warning(str(e))
+				logger.warning("Cannot restore previous legal classifier")
+			try:
+				scaler = joblib.load(scalePath, mmap_mode="c")
+				scaleModelTrained = True
+			except Exception as e:
+				logger.warning(str(e))
+		else:
+			# Train runs always start from scratch with the configured
+			# parameters - the current version is left as it is
+			try:
+				labelClf = Classifier.fromParams(name="LabelClassifier", **classifierParams)
+				legalClf = Classifier.fromParams(name="LegalClassifier", **classifierParams)
+			except Exception as e:
+				logger.exception(str(e))
+				logger.error("Could not create classifier instances")
+				raise SystemExit(-1)
+			# Always a fresh scaler: the feature matrices are sparse, so
+			# centering would densify them - and scalers stored by older
+			# versions (with_mean=True) cannot be refitted on them at all
+			scaler = StandardScaler(with_mean=False)
+		if mode == "apply" and not labelClfTrained and not legalClfTrained:
+			logger.error("Cannot apply empty models. Please train first")
 			raise SystemExit(-1)
+	elif mode in ("serve", "watch") and not os.path.exists(labelPath) and not os.path.exists(legalPath):
+		logger.error("Cannot apply empty models. Please train first")
+		raise SystemExit(-1)
 
 	db = DbConnector(
 		dbName=os.environ["TDSE_DB_NAME"],
 		userName=os.environ["TDSE_DB_USER"],
 		host=os.environ["DB_HOST"],
 		port=os.environ["TDSE_DB_PORT"],
-		password=os.environ["TDSE_DB_PASSWORD"]
+		password=os.environ["TDSE_DB_PASSWORD"],
+		featureCacheDir=args.outputDir + "/featureCache" if useFeatureCache else None,
+		sqlProfile=sqlProfile
 	)
 
 	labels, labelSession = db.getAllLabels()
@@ -348,20 +771,6 @@ def run():
 	labelModelsByLabel = {}
 	for label in labels:
 		labelModelsByLabel[label.label] = label
-	mode = args.mode;
-	if not mode:
-		if args.datasetPath:
-			mode = "train"
-		elif labelClfTrained and legalClfTrained:
-			mode = "apply"
-		else:
-			logger.error("Cannot apply empty models. Please train first")
-			raise SystemExit(-1)
-	else:
-		if mode == "apply" and not labelClfTrained and not legalClfTrained:
-			logger.error("Cannot apply empty models. Please train first")
-			raise SystemExit(-1)
-
 	language = args.language if args.language is not None else os.environ["CLASSIFIER_LANGUAGE"]
 
 	languageId = None
@@ -373,117 +782,217 @@ def run():
 	dfQuantile = args.minDocFrequency if args.minDocFrequency is not None else literal_eval(os.environ["CLASSIFIER_MIN_DF_FREQ"])
 	quantile = args.quantile if args.quantile is not None else literal_eval(os.environ["CLASSIFIER_QUANTILE"])
 	limit = args.limit if args.limit is not None else literal_eval(os.environ["CLASSIFIER_LIMIT"])
+	featureMode = args.featureMode if args.featureMode is not None else os.environ.get("CLASSIFIER_FEATURE_MODE", "bow")
+	if mode == "apply":
+		# The models only work with the features they were trained on
+		trainedWith = versionMetadata(modelDir)
+		for name, value in (("featureMode", featureMode), ("dfQuantile", dfQuantile)):
+			if name in trainedWith and trainedWith[name] != value:
+				logger.warning("Using {name} {stored} of the model version instead of {value}".format(
+					name=name,
+					stored=trainedWith[name],
+					value=value
+				))
+		featureMode = trainedWith.get("featureMode", featureMode)
+		dfQuantile = trainedWith.get("dfQuantile", dfQuantile)
+	sampling = args.sampling if args.sampling is not None else os.environ.get("CLASSIFIER_SAMPLING", "random")
 
-	if mode == "train":
-		dataset, trainingSession = db.getTrainingData(
-			limit=limit,
-			quantile=quantile,
-			mode="bow",
-			dfQuantile=dfQuantile,
-			languageIds=tuple([languageId])
-		)
-		X_train = []
-		Y_label = []
-		Y_legal = []
-		for dataEntry in dataset:
-			X_train.append(dataEntry[0])
-			model = dataEntry[1]
-			Y_legal.append(1 if model.legal else 0)
-			Y_label.append(model.primaryLabelLabelId)
-		X_train = np.array(X_train)
-		Y_legal = np.array(Y_legal)
-		Y_label = np.array(Y_label)
-
-		# Init scaler if not yet done
-		scaler.fit(X_train)
-		X_train = scaler.transform(X_train)
-
-		# store scaler (will be needed in the application phase)
-		storeModel(scalePath, scaler)
-
-		# train both classifiers
-		labelClf.train(X_train, Y_label)
-		legalClf.train(X_train, Y_legal)
-
-		storeModel(labelPath, labelClf.clf)
-		storeModel(legalPath, legalClf.clf)
-		trainingSession.commit()
-		trainingSession.close()
+	if mode == "tune" and svmType == "SGD":
+		logger.error("Tune mode needs the training matrix in memory - SGD is not supported")
+		raise SystemExit(-1)
+
+	if mode in ("train", "tune"):
+		from classifier import trainConcurrently
+		from reducer import fitReducer
+		from tuner import tune
+		from tuner import restrictGrid
+		import numpy as np
+		# All artifacts go to a fresh version, which only becomes current
+		# once the run completed
+		versionDir = registry.createVersion()
+		try:
+			legalPath, labelPath, scalePath, reducePath, vocabularyPath, idfPath = artifactPaths(versionDir)
+			# The vocabulary fixes the column layout - it has to be the same at
+			# apply time, even if the preprocessor inserted new terms meanwhile
+			vocabulary = db.getVocabulary(dfQuantile)
+			vocabulary.store(vocabularyPath, idfPath)
+			metadata = {
+				"created": datetime.datetime.now().isoformat(),
+				"classifierParams": classifierParams,
+				"featureMode": featureMode,
+				"dfQuantile": dfQuantile,
+				"quantile": quantile,
+				"limit": limit,
+				"language": language,
+				"retainedVariance": retainedVariance if reduce else None,
+				"vocabularySize": len(vocabulary),
+				"vocabularyVersion": vocabulary.version
+			}
+			if svmType == "SGD":
+				scaler = trainOutOfCore(
+					db,
+					[labelClf, legalClf],
+					batchSize=limit,
+					epochs=epochs,
+					quantile=quantile,
+					vocabulary=vocabulary,
+					languageIds=tuple([languageId]),
+					scalePath=scalePath,
+					labelPath=labelPath,
+					legalPath=legalPath,
+					reducePath=reducePath,
+					retainedVariance=retainedVariance if reduce else None,
+					featureMode=featureMode
+				)
+			else:
+				X_train, cleanContents, trainingSession = db.getTrainingData(
+					limit=limit,
+					quantile=quantile,
+					mode=featureMode,
+					dfQuantile=dfQuantile,
+					languageIds=tuple([languageId]),
+					vocabulary=vocabulary,
+					sampling=sampling
+				)
+				Y_legal = np.array([1 if model.legal else 0 for model in cleanContents])
+				Y_label = np.array([model.primaryLabelLabelId for model in cleanContents])
+
+				# Fit the fresh scaler
+				with instrumentation.phase("scale", docs=X_train.shape[0]) as record:
+					record.update(instrumentation.matrixInfo(X_train))
+					scaler.fit(X_train)
+					X_train = scaler.transform(X_train)
+
+				# store scaler (will be needed in the application phase)
+				storeModel(scalePath, scaler)
+
+				if reduce:
+					with instrumentation.phase("reduce", docs=X_train.shape[0]) as record:
+						reducer = fitReducer(X_train, retainedVariance)
+						X_train = reducer.transform(X_train)
+						record.update(instrumentation.matrixInfo(X_train))
+					storeModel(reducePath, reducer)
+
+				if mode == "tune":
+					halving = args.halving if args.halving is not None else literal_eval(os.environ.get("CLASSIFIER_TUNE_HALVING", "False"))
+					halvingFactor = args.halvingFactor if args.halvingFactor is not None else literal_eval(os.environ.get("CLASSIFIER_TUNE_FACTOR", "3"))
+					scoring = args.scoring if args.scoring is not None else os.environ.get("CLASSIFIER_TUNE_SCORING", "f1_macro")
+					tuneGrid = restrictGrid(tuneGrid, svmType, kernelType, approximation)
+					baseParams = dict((name, value) for name, value in classifierParams.items() if name not in tuneGrid)
+					metadata["tuning"] = {"grid": tuneGrid, "scoring": scoring, "halving": halving}
+					for name, target in (("LabelClassifier", Y_label), ("LegalClassifier", Y_legal)):
+						with instrumentation.phase("tune", classifier=name, docs=X_train.shape[0]):
+							bestParams, results = tune(
+								X_train,
+								target,
+								tuneGrid,
+								baseParams,
+								kFold=kFold,
+								scoring=scoring,
+								numThreads=numThreads,
+								halving=halving,
+								factor=halvingFactor
+							)
+						metadata["tuning"][name] = {"best": bestParams, "results": results}
+						params = dict(baseParams, **bestParams)
+						if name == "LabelClassifier":
+							labelClf = Classifier.fromParams(name=name, **params)
+						else:
+							legalClf = Classifier.fromParams(name=name, **params)
+
+				# train both classifiers
+				labelScores, legalScores = trainConcurrently(
+					[(labelClf, Y_label), (legalClf, Y_legal)],
+					X_train,
+					# tune mode already cross validated the candidates
+					kFold=kFold if crossValidate and mode == "train" else None,
+					numThreads=numThreads
+				)
+
+				storeModel(labelPath, labelClf.clf)
+				storeModel(legalPath, legalClf.clf)
+				trainingSession.commit()
+				trainingSession.close()
+				metadata["trainingSize"] = len(cleanContents)
+				metadata["labelScores"] = dict((name, float(np.mean(values))) for name, values in labelScores.items())
+				metadata["legalScores"] = dict((name, float(np.mean(values))) for name, values in legalScores.items())
+			registry.publish(versionDir, metadata)
+			if db.featureCacheDir is not None:
+				# Keep the caches of all vocabularies a rollback could return to
+				pruneFeatureCaches(db.featureCacheDir, registry.vocabularyVersions())
+		except BaseException:
+			# Never leave half-written versions behind
+			registry.discard(versionDir)
+			raise
 	elif mode == "apply":
 		if not scaleModelTrained:
 			logger.error("Please first run a train run - Otherwise, classification is impossible")
 			logger.error("If you did a test run check the outputModels directory - does it contain a scaleModel.clf?")
 			raise ValueError("scale model has to be trained first")
-		first = True
-		dataset = []
-		while len(dataset) >= limit or first:
-			first = False
-			dataset, labellingSession = db.getLabellingData(
-				limit=limit,
-				mode="bow",
-				dfQuantile=dfQuantile,
+		from applyEngine import ApplyEngine
+		from vocabulary import Vocabulary
+		try:
+			vocabulary = Vocabulary.restore(vocabularyPath, idfPath)
+		except Exception as e:
+			logger.exception(str(e))
+			logger.error("Please first run a train run - the vocabulary is stored alongside the models")
+			raise ValueError("vocabulary has to be created in the train run first")
+		engine = ApplyEngine(
+			db,
+			scalePath,
+			labelPath,
+			legalPath,
+			reducePath=reducePath if os.path.exists(reducePath) else None,
+			numWorkers=numThreads,
+			probaCertainty=probaCertainty
+		)
+		with instrumentation.phase("applyAll") as record:
+			labelledCount = engine.run(db.iterLabellingData(
+				batchSize=limit,
+				mode=featureMode,
+				vocabulary=vocabulary,
 				languageIds=tuple([languageId])
-			)
-			X_apply = []
-			cleanContents = []
-			for dataEntry in dataset:
-				X_apply.append(dataEntry[0])
-				cleanContents.append(dataEntry[1])
-			X_apply = np.array(X_apply)
-			X_apply = scaler.transform(X_apply)
-			
-			Y_label_r = labelClf.apply(X_apply)
-			Y_legal_r = legalClf.apply(X_apply)
-
-			for idx, cleanContent in enumerate(cleanContents):
-				label = Y_label_r[idx][0]
-				legal = Y_legal_r[idx][0]
-				labelCertainty = Y_label_r[idx][1]
-				legalCertainty = Y_legal_r[idx][1]
-				cleanContent.primaryLabelLabelId = label
-				cleanContent.legal = legal
-				cleanContent.labelCertainty = labelCertainty
-				cleanContent.legalCertainty = legalCertainty
-			labellingSession.commit()
-			labellingSession.close()
-			# Insertion via: Insert => on conflict do update legal&label
-			# => this way we get bulkupdate capabilities -- if needed
+			))
+			record["docs"] = labelledCount
+		logger.info("Apply finished, labelled {count} entries".format(count=labelledCount))
 	elif mode == "insert":
-		# TODO: read in specified csv file, insert those labelled entries into the db
-		# likely useful to introduce upsert behaviour
 		if not args.datasetPath:
 			logger.error("Please specify a dataset with -d if --mode insert is specified")
 			raise SystemExit(-1)
-		with open(args.datasetPath, ) as datasetFile:
-			reader = csv.DictReader(
-				datasetFile,
-				delimiter=";",
-				quoting=csv.QUOTE_NONE
-			)
-			insertSession = db.Session()
-			for row in reader:
-				values = {}
-				values["legalCertainty"] = 1.0
-				values["labelCertainty"] = 1.0
-				label = row["label"]
-				values["legal"] = "legal" == row["legal"]
-				try:
-					values["primaryLabelLabelId"] = labelModelsByLabel[label].labelId
-				except Exception as e:
-					logger.exception(str(e))
-					logger.error("Label: " + label)
-					raise SystemExit(-1)
-				insertSession.query(db.cleanContents).\
-					filter_by(cleanContentId = row["cleanContentId"]).\
-					update(values)
-			insertSession.commit()
-			insertSession.close()
+		labelIdsByLabel = {}
+		for label, labelModel in labelModelsByLabel.items():
+			labelIdsByLabel[label] = labelModel.labelId
+		insertDataset(db, args.datasetPath, labelIdsByLabel)
+	elif mode in ("serve", "watch"):
+		from watcher import Watcher
+		interval = args.interval if args.interval is not None else literal_eval(os.environ.get("CLASSIFIER_WATCH_INTERVAL", "10"))
+		notify = args.notify if args.notify is not None else literal_eval(os.environ.get("CLASSIFIER_WATCH_NOTIFY", "False"))
+		watcher = Watcher(
+			db,
+			registry,
+			args.outputDir,
+			featureMode=featureMode,
+			batchSize=literal_eval(os.environ.get("CLASSIFIER_WATCH_BATCH_SIZE", "100")),
+			languageIds=tuple([languageId]),
+			probaCertainty=probaCertainty,
+			interval=interval,
+			rescanInterval=literal_eval(os.environ.get("CLASSIFIER_WATCH_RESCAN_INTERVAL", "3600")),
+			channel=NOTIFY_CHANNEL if notify else None
+		)
+		labelledCount = watcher.run()
+		logger.info("Serve finished, labelled {count} entries".format(count=labelledCount))
+	elif mode == "materialize":
+		materializedCount = db.materializeTermCounts(batchSize=limit)
+		logger.info("Materialize finished, {count} new entries".format(count=materializedCount))
 	labelSession.commit()
 	labelSession.close()
+	if db.sqlProfiler is not None:
+		db.sqlProfiler.report(path=logLocation + "/classifier.sql.json", explainTop=sqlExplain)
 
 
 try:
-	run()
+	with instrumentation.phase("run", mode=args.mode):
+		run()
 except Exception as e:
 	logger.exception(str(e))
 	raise SystemExit(-1)
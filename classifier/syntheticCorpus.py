@@ -0,0 +1,232 @@
+"""Summary
+"""
+import numpy as np
+import logging
+import uuid
+import io
+
+logger = logging.getLogger("classifier.SyntheticCorpus")
+
+# The tables of the data preprocessor (see dataPreprocessing/models), as
+# far as the classifier reads them
+SCHEMA = "\
+CREATE TABLE labels (\n\
+	\"labelId\" uuid PRIMARY KEY,\n\
+	label text UNIQUE,\n\
+	\"numberOfDocs\" bigint DEFAULT 1,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now()\n\
+);\n\
+CREATE TABLE languages (\n\
+	\"languageId\" uuid PRIMARY KEY,\n\
+	language varchar(3),\n\
+	\"numberOfDocuments\" bigint DEFAULT 0,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now()\n\
+);\n\
+CREATE TABLE \"cleanContents\" (\n\
+	\"cleanContentId\" uuid PRIMARY KEY,\n\
+	\"cleanContent\" text DEFAULT '',\n\
+	\"rawContentId\" uuid NOT NULL,\n\
+	legal boolean DEFAULT true,\n\
+	\"legalCertainty\" double precision DEFAULT 0,\n\
+	\"labelCertainty\" double precision DEFAULT 0,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now(),\n\
+	\"languageLanguageId\" uuid REFERENCES languages,\n\
+	\"primaryLabelLabelId\" uuid REFERENCES labels\n\
+);\n\
+CREATE TABLE terms (\n\
+	\"termId\" uuid PRIMARY KEY,\n\
+	term text UNIQUE,\n\
+	\"documentFrequency\" bigint DEFAULT 0,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now()\n\
+);\n\
+CREATE TABLE postings (\n\
+	\"postingId\" uuid PRIMARY KEY,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now(),\n\
+	\"cleanContentCleanContentId\" uuid REFERENCES \"cleanContents\",\n\
+	\"termTermId\" uuid REFERENCES terms,\n\
+	UNIQUE (\"cleanContentCleanContentId\", \"termTermId\")\n\
+);\n\
+CREATE TABLE positions (\n\
+	\"positionId\" uuid PRIMARY KEY,\n\
+	position bigint UNIQUE,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now()\n\
+);\n\
+CREATE TABLE \"postingPositions\" (\n\
+	\"postingPositionId\" uuid PRIMARY KEY,\n\
+	\"postingId\" uuid REFERENCES postings,\n\
+	\"positionId\" uuid REFERENCES positions,\n\
+	\"createdAt\" timestamptz DEFAULT now(),\n\
+	\"updatedAt\" timestamptz DEFAULT now()\n\
+);\n"
+
+# Rows per COPY buffer
+COPY_CHUNK_SIZE = 100000
+# Documents whose postings are generated (and held in memory) at once
+DOC_CHUNK_SIZE = 1000
+
+DOCUMENT_FREQUENCY_QUERY = "\
+UPDATE terms\n\
+SET \"documentFrequency\" = frequencies.count\n\
+FROM (\n\
+	SELECT \"termTermId\", COUNT(*) AS count\n\
+	FROM postings\n\
+	GROUP BY \"termTermId\"\n\
+) AS frequencies\n\
+WHERE terms.\"termId\" = frequencies.\"termTermId\"\n"
+
+def _uuids(count):
+	# Drawn from the seeded generator, so a corpus is reproducible by its seed
+	raw = np.random.bytes(16 * count)
+	return [str(uuid.UUID(bytes=raw[idx * 16:(idx + 1) * 16], version=4)) for idx in range(count)]
+
+def _copy(cursor, table, columns, rows):
+	buffer = io.StringIO()
+	written = 0
+	for row in rows:
+		buffer.write("\t".join(row))
+		buffer.write("\n")
+		written += 1
+		if written % COPY_CHUNK_SIZE == 0:
+			_flush(cursor, table, columns, buffer)
+			buffer = io.StringIO()
+	_flush(cursor, table, columns, buffer)
+
+def _flush(cursor, table, columns, buffer):
+	buffer.seek(0)
+	cursor.copy_expert("COPY {table} ({columns}) FROM STDIN".format(
+		table=table,
+		columns=", ".join("\"{column}\"".format(column=column) for column in columns)
+	), buffer)
+
+def generateCorpus(
+	connection,
+	numDocs,
+	labels,
+	vocabularySize=5000,
+	docLength=200,
+	zipfExponent=1.1,
+	topicShare=0.3,
+	labelledShare=0.5,
+	seed=None
+):
+	"""Create the schema and fill it with a synthetic corpus
+
+	The term frequencies follow a Zipf distribution over the vocabulary.
+	Every label has a topic of its own: a Zipf distribution over a random
+	permutation of the vocabulary, from which topicShare of the tokens of
+	its documents are drawn. Hence the labels are learnable, but not
+	trivially separable. The legality of a document is drawn with the
+	legal share of its label.
+
+	Args:
+	    connection (connection): A psycopg2 connection to an empty database
+	    numDocs (int): Number of clean contents
+	    labels (Array.<dict>): The label mix, {labelId, label, share, legal}
+	    					   each. share and legal are probabilities
+	    vocabularySize (int, optional): Number of terms
+	    docLength (int, optional): Mean number of tokens per document
+	    zipfExponent (float, optional): Exponent of the term distribution
+	    topicShare (float, optional): Share of label specific tokens
+	    labelledShare (float, optional): Share of labelled documents (label
+	    								 and legal certainty 1), the others
+	    								 are left for the apply phase
+	    seed (int, optional): Seed of the random generator
+
+	Returns:
+	    dict: Number of rows per table
+	"""
+	np.random.seed(seed)
+	cursor = connection.cursor()
+	cursor.execute(SCHEMA)
+
+	labelIds = [label["labelId"] for label in labels]
+	_copy(cursor, "labels", ["labelId", "label"], zip(labelIds, [label["label"] for label in labels]))
+	languageId = _uuids(1)[0]
+	_copy(cursor, "languages", ["languageId", "language"], [(languageId, "en")])
+
+	ranks = np.arange(1, vocabularySize + 1, dtype=np.float64)
+	background = ranks ** -zipfExponent
+	background /= background.sum()
+	topics = [background[np.argsort(np.random.permutation(vocabularySize))] for _ in labels]
+	shares = np.array([label["share"] for label in labels], dtype=np.float64)
+	docLabels = np.random.choice(len(labels), size=numDocs, p=shares / shares.sum())
+	docLegals = np.random.random(numDocs) < np.array([label["legal"] for label in labels])[docLabels]
+	labelled = np.random.random(numDocs) < labelledShare
+	lengths = np.maximum(1, np.random.poisson(docLength, size=numDocs))
+
+	docIds = _uuids(numDocs)
+	_copy(cursor, "\"cleanContents\"", [
+		"cleanContentId",
+		"rawContentId",
+		"legal",
+		"legalCertainty",
+		"labelCertainty",
+		"languageLanguageId",
+		"primaryLabelLabelId"
+	], (
+		(
+			docIds[idx],
+			rawContentId,
+			"t" if docLegals[idx] else "f",
+			"1" if labelled[idx] else "0",
+			"1" if labelled[idx] else "0",
+			languageId,
+			labelIds[docLabels[idx]] if labelled[idx] else "\\N"
+		) for idx, rawContentId in enumerate(_uuids(numDocs))
+	))
+
+	positionIds = _uuids(int(lengths.max()))
+	_copy(cursor, "positions", ["positionId", "position"], (
+		(positionId, str(position)) for position, positionId in enumerate(positionIds)
+	))
+
+	termIds = _uuids(vocabularySize)
+	_copy(cursor, "terms", ["termId", "term"], (
+		(termId, "term{idx}".format(idx=idx)) for idx, termId in enumerate(termIds)
+	))
+	numPostings = 0
+	numPostingPositions = 0
+	for chunkStart in range(0, numDocs, DOC_CHUNK_SIZE):
+		postings = []
+		postingPositions = []
+		for idx in range(chunkStart, min(numDocs, chunkStart + DOC_CHUNK_SIZE)):
+			numTopic = np.random.binomial(lengths[idx], topicShare)
+			tokens = np.concatenate([
+				np.random.choice(vocabularySize, size=lengths[idx] - numTopic, p=background),
+				np.random.choice(vocabularySize, size=numTopic, p=topics[docLabels[idx]])
+			])
+			np.random.shuffle(tokens)
+			# order[i] is the position of the i-th token when sorted by term
+			order = np.argsort(tokens, kind="stable")
+			terms, starts = np.unique(tokens[order], return_index=True)
+			postingIds = _uuids(len(terms))
+			postings.extend((postingId, docIds[idx], termIds[term]) for postingId, term in zip(postingIds, terms))
+			ownerPostings = np.repeat(np.arange(len(terms)), np.diff(np.append(starts, len(tokens))))
+			postingPositions.extend(zip(
+				_uuids(len(tokens)),
+				[postingIds[owner] for owner in ownerPostings],
+				[positionIds[position] for position in order]
+			))
+		_copy(cursor, "postings", ["postingId", "cleanContentCleanContentId", "termTermId"], postings)
+		_copy(cursor, "\"postingPositions\"", ["postingPositionId", "postingId", "positionId"], postingPositions)
+		numPostings += len(postings)
+		numPostingPositions += len(postingPositions)
+	cursor.execute(DOCUMENT_FREQUENCY_QUERY)
+	cursor.execute("ANALYZE")
+	connection.commit()
+	cursor.close()
+	counts = {
+		"cleanContents": numDocs,
+		"labelled": int(labelled.sum()),
+		"terms": vocabularySize,
+		"postings": numPostings,
+		"postingPositions": numPostingPositions
+	}
+	logger.info("Generated synthetic corpus: {counts}".format(counts=counts))
+	return counts
@@ -0,0 +1,8 @@
+"""Summary
+"""
+import sys
+import os
+
+# The classifier modules import each other as top-level modules (they are
+# run from the classifier directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+"""Summary
+"""
+from argumentTypes import numberOrList
+from argumentTypes import GAMMA_KEYWORDS
+import pytest
+
+def test_number():
+	assert numberOrList(float)("10") == 10.0
+	assert isinstance(numberOrList(float)("38"), float)
+	assert numberOrList(int)("3") == 3
+
+def test_list():
+	assert numberOrList(float)("[1, 10, 100]") == [1.0, 10.0, 100.0]
+	assert numberOrList(int)("(2, 3)") == [2, 3]
+	assert all(isinstance(value, float) for value in numberOrList(float)("[1, 2]"))
+
+def test_invalid():
+	with pytest.raises(ValueError):
+		numberOrList(float)("auto")
+
+def test_keywords():
+	assert numberOrList(float, GAMMA_KEYWORDS)("auto") == "auto"
+	assert numberOrList(float, GAMMA_KEYWORDS)("38") == 38.0
+	assert numberOrList(float, GAMMA_KEYWORDS)("['scale', 0.1]") == ["scale", 0.1]
+	with pytest.raises(ValueError):
+		numberOrList(float, GAMMA_KEYWORDS)("['large']")
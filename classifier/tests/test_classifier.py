@@ -0,0 +1,72 @@
+"""Summary
+"""
+from sklearn import svm
+from classifier import Classifier
+from scipy import sparse
+import numpy as np
+import pytest
+
+def loopApply(clf, datacolumns):
+	# The per-row implementation Classifier.apply replaced
+	scores = clf.decision_function(datacolumns)
+	probaScores = clf.predict_proba(datacolumns)
+	results = []
+	for i in range(0, datacolumns.shape[0]):
+		scoreMax = np.max(scores[i])
+		try:
+			scorePos = [i for i, x in enumerate(scores[i]) if x == scoreMax][0]
+			scoreDecision = clf.classes_[scorePos]
+		except Exception:
+			scoreMax = np.max(scores[i])
+			scoreDecision = 0 if scoreMax < 0 else 1
+			scorePos = scoreDecision
+		scoreProba = probaScores[i][scorePos]
+		if scoreProba > 0.99:
+			scoreProba = 0.99
+		results.append((scoreDecision, scoreProba))
+	return results
+
+def loopScoreCertainty(scores):
+	certainties = []
+	for row in scores:
+		if np.ndim(row) == 0:
+			certainties.append(1.0 / (1.0 + np.exp(-abs(row))))
+		else:
+			exponentials = [np.exp(score - max(row)) for score in row]
+			certainties.append(max(exponentials) / sum(exponentials))
+	return np.array(certainties)
+
+def samples(numClasses, seed=0):
+	random = np.random.RandomState(seed)
+	centers = random.rand(numClasses, 10) * 4
+	targets = np.arange(200) % numClasses
+	datacolumns = centers[targets] + random.rand(200, 10) * 2
+	return sparse.csr_matrix(datacolumns), targets
+
+@pytest.mark.parametrize("numClasses", [2, 4])
+def test_applyMatchesTheLoop(numClasses):
+	datacolumns, targets = samples(numClasses)
+	clf = svm.SVC(kernel="rbf", gamma="scale", probability=True, random_state=0).fit(datacolumns, targets)
+	decisions, certainties = Classifier.fromModel(clf, "Test").apply(datacolumns)
+	expected = loopApply(clf, datacolumns)
+	assert list(decisions) == [decision for decision, _ in expected]
+	assert np.allclose(certainties, [certainty for _, certainty in expected])
+	assert np.all(certainties <= 0.99)
+
+@pytest.mark.parametrize("numClasses", [2, 4])
+def test_scoreCertaintyMatchesTheLoop(numClasses):
+	datacolumns, targets = samples(numClasses)
+	clf = svm.SVC(kernel="linear", random_state=0).fit(datacolumns, targets)
+	classifier = Classifier.fromModel(clf, "Test")
+	scores = clf.decision_function(datacolumns)
+	assert np.allclose(classifier._scoreCertainty(scores), loopScoreCertainty(scores))
+	decisions, certainties = classifier.apply(datacolumns, useProba=False)
+	assert np.allclose(certainties, np.minimum(loopScoreCertainty(scores), 0.99))
+	assert list(decisions) == list(clf.predict(datacolumns))
+
+def test_applyWithoutSamples():
+	datacolumns, targets = samples(2)
+	clf = svm.SVC(kernel="linear").fit(datacolumns, targets)
+	decisions, certainties = Classifier.fromModel(clf, "Test").apply(datacolumns[:0])
+	assert len(decisions) == 0
+	assert len(certainties) == 0
@@ -0,0 +1,95 @@
+"""Summary
+"""
+from featureCache import FeatureCache
+from featureCache import MERGE_FACTOR
+from featureCache import pruneFeatureCaches
+from dbConnector import DbConnector
+from vocabulary import Vocabulary
+from scipy import sparse
+import numpy as np
+import logging
+import os
+
+IDS = ["{idx}0000000-0000-4000-8000-000000000000".format(idx=idx) for idx in range(8)]
+VOCABULARY = Vocabulary(["{idx}0000000-0000-4000-8000-00000000000f".format(idx=idx) for idx in range(3)])
+
+def vector(value):
+	return sparse.csr_matrix([[value, 0, value]], dtype=np.float64)
+
+def test_mergeDropsSupersededRows(tmpdir):
+	cache = FeatureCache(str(tmpdir), "bow", VOCABULARY)
+	cache.put([IDS[0]], [1.0], vector(1))
+	cache.put([IDS[1]], [1.0], vector(2))
+	cache.put([IDS[2]], [1.0], vector(3))
+	assert len(cache.segments) == MERGE_FACTOR - 1
+	# Changed clean content: the new row supersedes the first one
+	cache.put([IDS[0]], [2.0], vector(4))
+	assert len(cache.segments) == 1
+	assert cache.segments[0].shape[0] == 3
+	positions, hits, missing = cache.get([IDS[2], IDS[0], IDS[1]], [1.0, 2.0, 1.0])
+	assert missing == []
+	rows = dict(zip(positions, hits.toarray()[:, 0]))
+	assert rows == {0: 3, 1: 4, 2: 2}
+
+def test_changedMarkersAreMissing(tmpdir):
+	cache = FeatureCache(str(tmpdir), "bow", VOCABULARY)
+	cache.put(IDS[:2], [1.0, 1.0], sparse.vstack([vector(1), vector(2)]))
+	positions, hits, missing = cache.get([IDS[0], IDS[1], IDS[2]], [1.0, 5.0, 1.0])
+	assert positions == [0]
+	assert missing == [1, 2]
+
+def test_reloadKeepsTheSegments(tmpdir):
+	cache = FeatureCache(str(tmpdir), "bow", VOCABULARY)
+	for idx in range(MERGE_FACTOR + 1):
+		cache.put([IDS[idx]], [1.0], vector(idx))
+	reloaded = FeatureCache(str(tmpdir), "bow", VOCABULARY)
+	assert len(reloaded) == MERGE_FACTOR + 1
+	assert reloaded.segmentNames == cache.segmentNames
+	positions, hits, missing = reloaded.get(IDS[:MERGE_FACTOR + 1], [1.0] * (MERGE_FACTOR + 1))
+	assert missing == []
+	assert dict(zip(positions, hits.toarray()[:, 0])) == dict((idx, idx) for idx in range(MERGE_FACTOR + 1))
+
+def test_pruneKeepsRegisteredVocabularies(tmpdir):
+	FeatureCache(str(tmpdir), "bow", VOCABULARY)
+	FeatureCache(str(tmpdir), "sow", VOCABULARY)
+	os.makedirs(str(tmpdir.join("bow-outdated")))
+	pruneFeatureCaches(str(tmpdir), [VOCABULARY.version])
+	assert sorted(os.listdir(str(tmpdir))) == sorted([
+		"bow-" + VOCABULARY.version,
+		"sow-" + VOCABULARY.version
+	])
+
+def connector(cacheDir, fetched):
+	db = DbConnector.__new__(DbConnector)
+	db.logger = logging.getLogger("classifier.test")
+	db.featureCacheDir = cacheDir
+	db.featureCache = None
+	db._featureCacheKey = None
+
+	def fetchVectors(cleanContentIds, mode, vocabulary):
+		fetched.append(list(cleanContentIds))
+		return sparse.vstack([vector(IDS.index(i)) for i in cleanContentIds], format="csr")
+	db._fetchVectors = fetchVectors
+	return db
+
+def test_getVectorsByIdKeepsTheRequestedOrder(tmpdir):
+	fetched = []
+	db = connector(str(tmpdir), fetched)
+	db.getVectorsById([IDS[3], IDS[1]], "bow", VOCABULARY, markers=[1.0, 1.0])
+	requested = [IDS[5], IDS[1], IDS[4], IDS[3], IDS[6]]
+	# IDS[4] changed since it was cached
+	db.getVectorsById([IDS[4]], "bow", VOCABULARY, markers=[1.0])
+	X = db.getVectorsById(requested, "bow", VOCABULARY, markers=[1.0, 1.0, 2.0, 1.0, 1.0])
+	assert list(X.toarray()[:, 0]) == [5, 1, 4, 3, 6]
+	assert fetched[-1] == [IDS[5], IDS[4], IDS[6]]
+	# Everything is cached now
+	X = db.getVectorsById(requested[::-1], "bow", VOCABULARY, markers=[1.0, 1.0, 2.0, 1.0, 1.0])
+	assert list(X.toarray()[:, 0]) == [6, 3, 4, 1, 5]
+	assert len(fetched) == 3
+
+def test_getVectorsByIdWithoutMarkersBypassesTheCache(tmpdir):
+	fetched = []
+	db = connector(str(tmpdir), fetched)
+	db.getVectorsById(IDS[:2], "bow", VOCABULARY)
+	db.getVectorsById(IDS[:2], "bow", VOCABULARY)
+	assert len(fetched) == 2
@@ -0,0 +1,62 @@
+"""Summary
+"""
+from modelRegistry import ModelRegistry
+from modelRegistry import MAX_VERSIONS
+import pytest
+import os
+
+def publish(registry, **metadata):
+	directory = registry.createVersion()
+	with open(os.path.join(directory, "labelModel.clf"), "w") as artifact:
+		artifact.write("model")
+	return registry.publish(directory, metadata)
+
+def test_publishSwitchesCurrent(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	assert registry.currentVersion() is None
+	version = publish(registry, featureMode="bow")
+	assert registry.versions() == [version]
+	assert registry.currentVersion() == version
+	assert os.path.exists(os.path.join(registry.currentDirectory(), "labelModel.clf"))
+	assert registry.metadata() == {"featureMode": "bow", "version": version}
+
+def test_unpublishedVersionsAreInvisible(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	directory = registry.createVersion()
+	assert registry.versions() == []
+	registry.discard(directory)
+	assert not os.path.exists(directory)
+
+def test_rollback(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	first = publish(registry)
+	second = publish(registry)
+	third = publish(registry)
+	assert registry.rollback() == second
+	assert registry.currentVersion() == second
+	assert registry.rollback(third) == third
+	assert registry.rollback(first) == first
+	with pytest.raises(ValueError):
+		registry.rollback()
+	with pytest.raises(ValueError):
+		registry.rollback("unknown")
+
+def test_pruneKeepsTheNewestVersions(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	versions = [publish(registry) for _ in range(MAX_VERSIONS + 2)]
+	assert registry.versions() == versions[2:]
+	assert registry.currentVersion() == versions[-1]
+
+def test_switchToUnknownVersion(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	version = publish(registry)
+	with pytest.raises(ValueError):
+		registry.switch("unknown")
+	assert registry.currentVersion() == version
+
+def test_vocabularyVersions(tmpdir):
+	registry = ModelRegistry(str(tmpdir))
+	publish(registry, vocabularyVersion="a")
+	publish(registry)
+	publish(registry, vocabularyVersion="b")
+	assert registry.vocabularyVersions() == ["a", "b"]
@@ -0,0 +1,59 @@
+"""Summary
+"""
+from tuner import tune
+from tuner import restrictGrid
+from scipy import sparse
+import numpy as np
+
+def samples(numSamples, seed=0):
+	random = np.random.RandomState(seed)
+	datacolumns = random.rand(numSamples, 10)
+	targets = (datacolumns[:, 0] + datacolumns[:, 1] > 1).astype(int)
+	return sparse.csr_matrix(datacolumns), targets
+
+def roundSizes(results):
+	sizes = {}
+	for result in results:
+		sizes.setdefault(result["round"], []).append(result["samples"])
+	return dict((roundIdx, (len(entries), entries[0])) for roundIdx, entries in sizes.items())
+
+def test_halvingStopsAtOneSurvivor():
+	# 301 samples: 9 candidates on 100, 3 on 300 - the single survivor of
+	# the second round must not get a round on all 301 samples of its own
+	datacolumns, targets = samples(301)
+	best, results = tune(
+		datacolumns,
+		targets,
+		{"cost": [0.001, 0.01, 0.1, 1.0, 10.0, 100.0, 0.003, 0.03, 0.3]},
+		{"svmType": "LinearSVC"},
+		kFold=2,
+		halving=True,
+		factor=3,
+		seed=0
+	)
+	assert roundSizes(results) == {0: (9, 100), 1: (3, 300)}
+	lastRound = [result for result in results if result["round"] == 1]
+	assert best == max(lastRound, key=lambda result: result["meanScore"])["params"]
+
+def test_withoutHalvingOneRoundOnAllSamples():
+	datacolumns, targets = samples(200)
+	best, results = tune(
+		datacolumns,
+		targets,
+		{"cost": [0.01, 1.0, 100.0]},
+		{"svmType": "LinearSVC"},
+		kFold=2,
+		seed=0
+	)
+	assert roundSizes(results) == {0: (3, 200)}
+	assert best in [{"cost": cost} for cost in (0.01, 1.0, 100.0)]
+
+GRID = {"cost": [1.0, 10.0], "nu": [0.1, 0.5], "degree": [2, 3], "gamma": ["auto", 0.1]}
+
+def test_gridsOnlyHoldTheUsedParameters():
+	assert sorted(restrictGrid(GRID, "C_SVC", "linear")) == ["cost"]
+	assert sorted(restrictGrid(GRID, "C_SVC", "rbf")) == ["cost", "gamma"]
+	assert sorted(restrictGrid(GRID, "NU_SVC", "RBF")) == ["gamma", "nu"]
+	assert sorted(restrictGrid(GRID, "NU_SVC", "poly")) == ["degree", "gamma", "nu"]
+	assert sorted(restrictGrid(GRID, "LinearSVC", "rbf")) == ["cost"]
+	assert sorted(restrictGrid(GRID, "LinearSVC", "linear", "nystroem")) == ["cost", "gamma"]
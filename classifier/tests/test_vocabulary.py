@@ -0,0 +1,50 @@
+"""Summary
+"""
+from vocabulary import Vocabulary
+import numpy as np
+
+TERM_IDS = [
+	"c0000000-0000-4000-8000-000000000000",
+	"a0000000-0000-4000-8000-000000000000",
+	"b0000000-0000-4000-8000-000000000000"
+]
+UNKNOWN_ID = "d0000000-0000-4000-8000-000000000000"
+
+def test_columnsAreSortedTermIds():
+	vocabulary = Vocabulary(TERM_IDS)
+	assert list(vocabulary.termIds) == sorted(TERM_IDS)
+	assert list(vocabulary.columnsOf(TERM_IDS)) == [2, 0, 1]
+
+def test_columnsFollowTheRequestedOrder():
+	vocabulary = Vocabulary(TERM_IDS)
+	requested = [TERM_IDS[1], TERM_IDS[1], TERM_IDS[0]]
+	assert list(vocabulary.columnsOf(requested)) == [0, 0, 2]
+
+def test_unknownTermsHaveNoColumn():
+	vocabulary = Vocabulary(TERM_IDS)
+	# Before the first, between and after the last termId
+	requested = [
+		"00000000-0000-4000-8000-000000000000",
+		"a1000000-0000-4000-8000-000000000000",
+		UNKNOWN_ID,
+		TERM_IDS[2]
+	]
+	assert list(vocabulary.columnsOf(requested)) == [-1, -1, -1, 1]
+
+def test_emptyVocabulary():
+	vocabulary = Vocabulary([])
+	assert list(vocabulary.columnsOf(TERM_IDS)) == [-1, -1, -1]
+
+def test_idfFollowsTheColumns():
+	vocabulary = Vocabulary(TERM_IDS, idf=[3.0, 1.0, 2.0])
+	columns = vocabulary.columnsOf(TERM_IDS)
+	assert np.array_equal(vocabulary.idf[columns], [3.0, 1.0, 2.0])
+
+def test_restoreKeepsTheVersion(tmpdir):
+	vocabulary = Vocabulary(TERM_IDS, idf=[3.0, 1.0, 2.0])
+	path = str(tmpdir.join("vocabulary.npy"))
+	idfPath = str(tmpdir.join("idf.npy"))
+	vocabulary.store(path, idfPath)
+	restored = Vocabulary.restore(path, idfPath)
+	assert restored.version == vocabulary.version
+	assert list(restored.columnsOf(TERM_IDS)) == [2, 0, 1]
@@ -0,0 +1,190 @@
+"""Summary
+"""
+from sklearn.model_selection import ParameterGrid
+from sklearn.model_selection import StratifiedKFold
+from sklearn.metrics import get_scorer
+import joblib
+from classifier import Classifier
+from classifier import SHARED_MEMORY_THRESHOLD
+from instrumentation import phase
+import instrumentation
+import numpy as np
+import logging
+import math
+
+logger = logging.getLogger("classifier.Tuner")
+
+# Smallest number of samples a successive halving round is run on
+MIN_HALVING_SAMPLES = 100
+
+# Kernels of the SVC/NuSVC models that take gamma and degree
+GAMMA_KERNELS = ("rbf", "poly", "polynomial", "sigmoid")
+DEGREE_KERNELS = ("poly", "polynomial")
+
+def _evaluate(params, datacolumns, targetcolumn, train, test, scoring, instrumentationSettings):
+	# Runs in a worker process - apply the settings of the parent
+	instrumentation.configure(**instrumentationSettings)
+	clf = Classifier.fromParams(name="Tuner", **params).clf
+	with phase("tuneFit", docs=len(train)):
+		clf.fit(datacolumns[train], targetcolumn[train])
+	return get_scorer(scoring)(clf, datacolumns[test], targetcolumn[test])
+
+def gridParams(svmType, kernelType, approximation=None):
+	"""Get the tunable parameters a classifier type actually uses
+
+	Args:
+	    svmType (str): C_SVC, NU_SVC, LinearSVC or SGD
+	    kernelType (str): The kernel of C_SVC/NU_SVC
+	    approximation (str, optional): The kernel approximation, see
+	    							   Classifier.fromParams
+
+	Returns:
+	    Array.<str>: The parameter names of Classifier.fromParams
+	"""
+	if approximation is not None:
+		# A linear model behind an explicit map of the RBF kernel
+		return ["gamma"] if svmType == "SGD" else ["cost", "gamma"]
+	if svmType in ("LinearSVC", "SGD"):
+		return ["cost"] if svmType == "LinearSVC" else []
+	params = ["nu"] if svmType == "NU_SVC" else ["cost"]
+	kernelType = kernelType.lower()
+	if kernelType in GAMMA_KERNELS:
+		params.append("gamma")
+	if kernelType in DEGREE_KERNELS:
+		params.append("degree")
+	return params
+
+def restrictGrid(grid, svmType, kernelType, approximation=None):
+	"""Drop the parameters the classifier type does not use from a grid
+
+	Tuning them would only fit identical models once per value.
+
+	Args:
+	    grid (dict): Parameter name -> Array of candidate values
+	    svmType (str): C_SVC, NU_SVC, LinearSVC or SGD
+	    kernelType (str): The kernel of C_SVC/NU_SVC
+	    approximation (str, optional): The kernel approximation
+
+	Returns:
+	    dict: The grid of the used parameters
+	"""
+	used = gridParams(svmType, kernelType, approximation)
+	for name, values in grid.items():
+		if name not in used and len(values) > 1:
+			logger.warning("{svmType}/{kernelType} does not use {name}, ignoring its candidates {values}".format(
+				svmType=svmType,
+				kernelType=kernelType,
+				name=name,
+				values=values
+			))
+	return dict((name, values) for name, values in grid.items() if name in used)
+
+def tune(
+	datacolumns,
+	targetcolumn,
+	grid,
+	baseParams,
+	kFold=4,
+	scoring="f1_macro",
+	numThreads=1,
+	halving=False,
+	factor=3,
+	seed=None
+):
+	"""Search the best parameters of a classifier by k-fold cross validation
+
+	All (candidate, fold) fits of a round run in parallel on a process
+	pool; the samples are shared with the workers as memory maps (see
+	trainConcurrently). Without halving, every candidate is evaluated on
+	all samples in a single round. With successive halving, the first
+	round evaluates all candidates on a subsample, and every further round
+	keeps the best 1/factor of the candidates and multiplies the number of
+	samples by factor, until one candidate is left or all samples are used.
+
+	Args:
+	    datacolumns (csr_matrix): The (scaled) samples, one per row
+	    targetcolumn (numpy.ndarray): The target class per sample
+	    grid (dict): Parameter name of Classifier.fromParams -> Array of
+	    			 candidate values
+	    baseParams (dict): The fixed parameters of Classifier.fromParams
+	    kFold (int, optional): Number of cross validation folds
+	    scoring (str, optional): A scikit-learn scoring, e.g. "accuracy"
+	    numThreads (int, optional): Number of worker processes
+	    halving (bool, optional): Use successive halving
+	    factor (int, optional): Halving factor
+	    seed (int, optional): Seed of the folds and subsamples
+
+	Returns:
+	    dict: The best parameters (of the grid)
+	    Array.<dict>: The results of all rounds: params, round, samples,
+	    			  meanScore and stdScore per candidate
+	"""
+	candidates = list(ParameterGrid(grid))
+	numSamples = datacolumns.shape[0]
+	random = np.random.RandomState(seed)
+	# Nested subsamples - a later round sees all samples of the earlier ones
+	permutation = random.permutation(numSamples)
+	numRounds = 1
+	if halving and len(candidates) > 1:
+		numRounds = int(math.ceil(math.log(len(candidates), factor)))
+	samples = max(MIN_HALVING_SAMPLES, numSamples // factor ** (numRounds - 1))
+	results = []
+	roundIdx = 0
+	while True:
+		subset = np.sort(permutation[:min(samples, numSamples)])
+		X = datacolumns[subset]
+		Y = targetcolumn[subset]
+		folds = list(StratifiedKFold(n_splits=kFold, shuffle=True, random_state=random).split(np.zeros(len(Y)), Y))
+		logger.info("Round {round}: {candidates} candidates on {samples} samples".format(
+			round=roundIdx,
+			candidates=len(candidates),
+			samples=len(subset)
+		))
+		with phase("tuneRound", round=roundIdx, candidates=len(candidates), docs=len(subset)):
+			scores = joblib.Parallel(
+				n_jobs=numThreads,
+				max_nbytes=SHARED_MEMORY_THRESHOLD,
+				mmap_mode="r"
+			)(
+				joblib.delayed(_evaluate)(
+					dict(baseParams, **candidate),
+					X,
+					Y,
+					train,
+					test,
+					scoring,
+					instrumentation.settings()
+				)
+				for candidate in candidates
+				for train, test in folds
+			)
+		scores = np.array(scores).reshape(len(candidates), len(folds))
+		ranked = []
+		for candidate, candidateScores in zip(candidates, scores):
+			result = {
+				"params": candidate,
+				"round": roundIdx,
+				"samples": len(subset),
+				"meanScore": float(np.mean(candidateScores)),
+				"stdScore": float(np.std(candidateScores))
+			}
+			logger.info("{params}: {scoring} {mean:.4f} (+/- {std:.4f})".format(
+				params=candidate,
+				scoring=scoring,
+				mean=result["meanScore"],
+				std=result["stdScore"]
+			))
+			results.append(result)
+			ranked.append(result)
+		ranked.sort(key=lambda result: result["meanScore"], reverse=True)
+		candidates = [result["params"] for result in ranked]
+		if len(subset) >= numSamples:
+			break
+		candidates = candidates[:max(1, int(math.ceil(len(candidates) / float(factor))))]
+		# A single survivor is the winner, it needs no round of its own
+		if len(candidates) == 1:
+			break
+		samples *= factor
+		roundIdx += 1
+	logger.info("Best parameters: {params}".format(params=candidates[0]))
+	return candidates[0], results
@@ -0,0 +1,107 @@
+"""Summary
+"""
+import numpy as np
+import hashlib
+import os
+
+class Vocabulary(object):
+	"""The feature space of the classifier: maps termIds to column indices
+
+	The termIds are kept sorted in a plain numpy array, the column index of
+	a term is its position in that array. This keeps the artifact compact
+	and the lookup vectorized (binary search). Optionally, the inverse
+	document frequency of every column is kept for TF-IDF weighting.
+
+	Attributes:
+	    termIds (numpy.ndarray): The sorted termIds, one per column
+	    idf (numpy.ndarray): The IDF per column, None if unknown
+	"""
+	def __init__(self, termIds, idf=None):
+		"""Summary
+
+		Args:
+		    termIds (Array.<str>): The termIds spanning the feature space
+		    idf (Array.<float>, optional): The IDF of every termId
+		"""
+		super(Vocabulary, self).__init__()
+		self.termIds, order = np.unique(np.array([str(termId) for termId in termIds], dtype="U36"), return_index=True)
+		self.idf = np.asarray(idf, dtype=np.float64)[order] if idf is not None else None
+
+	def __len__(self):
+		return len(self.termIds)
+
+	@property
+	def version(self):
+		"""A short fingerprint of the feature space
+
+		Two vocabularies with the same version have the same column layout.
+
+		Returns:
+		    str: Hex digest over all termIds
+		"""
+		return hashlib.sha1(self.termIds.tobytes()).hexdigest()[:16]
+
+	def columnsOf(self, termIds):
+		"""Get the column indices for the given termIds
+
+		Args:
+		    termIds (Array.<str>): The termIds to look up
+
+		Returns:
+		    numpy.ndarray: The column index per termId, -1 if the term is not
+		    			   part of the vocabulary
+		"""
+		termIds = np.array([str(termId) for termId in termIds], dtype="U36")
+		columns = np.searchsorted(self.termIds, termIds)
+		columns[columns >= len(self.termIds)] = 0
+		found = len(self.termIds) > 0 and self.termIds[columns] == termIds
+		return np.where(found, columns, -1)
+
+	def weigh(self, X):
+		"""Apply the TF-IDF weighting to term count vectors
+
+		Args:
+		    X (csr_matrix): Term counts, one column per vocabulary entry
+
+		Returns:
+		    csr_matrix: The weighted copy of X
+
+		Raises:
+		    ValueError: If the vocabulary has no IDF
+		"""
+		if self.idf is None:
+			raise ValueError("The vocabulary has no IDF - train with the tfidf feature mode first")
+		X = X.copy()
+		X.data = X.data * self.idf[X.indices]
+		return X
+
+	def store(self, path, idfPath=None):
+		"""Store the vocabulary as .npy file
+
+		Args:
+		    path (str): The file path
+		    idfPath (str, optional): The file path of the IDF, not stored if
+		    						 None
+		"""
+		with open(path, "wb") as vocabularyFile:
+			np.save(vocabularyFile, self.termIds, allow_pickle=False)
+		if idfPath is not None and self.idf is not None:
+			with open(idfPath, "wb") as idfFile:
+				np.save(idfFile, self.idf, allow_pickle=False)
+
+	@classmethod
+	def restore(cls, path, idfPath=None):
+		"""Restore a vocabulary stored with store
+
+		Args:
+		    path (str): The file path
+		    idfPath (str, optional): The file path of the IDF, skipped if
+		    						 None or missing
+
+		Returns:
+		    Vocabulary: The restored vocabulary
+		"""
+		idf = None
+		if idfPath is not None and os.path.exists(idfPath):
+			idf = np.load(idfPath, allow_pickle=False)
+		return cls(np.load(path, allow_pickle=False), idf)
@@ -0,0 +1,207 @@
+"""Summary
+"""
+import joblib
+from classifier import Classifier
+from modelRegistry import artifactPaths
+from modelRegistry import versionMetadata
+from vocabulary import Vocabulary
+import logging
+import signal
+import datetime
+import time
+import os
+
+# Clean contents created this long before the newest one seen are scanned
+# again - the preprocessor stamps createdAt on insert, but commits the clean
+# content and its postings only at the end of its transaction. Transactions
+# committing even later are caught by the periodic full scan.
+HIGH_WATER_MARK_LAG = datetime.timedelta(minutes=10)
+
+class Watcher(object):
+	"""Long-running classification of newly preprocessed clean contents
+
+	The models, the vocabulary and the DB engine are loaded once and kept
+	warm. Every cycle labels all pending clean contents in micro-batches and
+	then sleeps until the next poll - or, with a notification channel, until
+	the preprocessor inserted new clean contents. The first cycle and then
+	one cycle every rescanInterval scan all pending clean contents, the
+	others only those created since the previous cycle (minus
+	HIGH_WATER_MARK_LAG). A model version published meanwhile
+	(see ModelRegistry) is picked up at the start of the next cycle, along
+	with the feature mode it was trained with.
+
+	Attributes:
+	    db (DbConnector): The db connector
+	    logger (Logger): The logger
+	    registry (ModelRegistry): The registry of the models to apply
+	    fallbackDir (str): The flat model directory used if the registry has
+	    				   no current version
+	    featureMode (str): The feature mode the loaded models were trained
+	    				   with
+	    defaultFeatureMode (str): The feature mode of model versions without
+	    						  metadata
+	    batchSize (int): Number of entries per micro-batch
+	    languageIds (Array.<str>): Restrict to these languages
+	    probaCertainty (bool): See Classifier.apply
+	    interval (float): Seconds between two polls
+	    rescanInterval (float): Seconds between two scans of all pending
+	    						clean contents
+	    channel (str): The notification channel, None to poll only
+	"""
+	def __init__(
+		self,
+		db,
+		registry,
+		fallbackDir,
+		featureMode="bow",
+		batchSize=100,
+		languageIds=None,
+		probaCertainty=True,
+		interval=10,
+		rescanInterval=3600,
+		channel=None
+	):
+		"""Summary
+
+		Args:
+		    db (DbConnector): The db connector
+		    registry (ModelRegistry): The registry of the models to apply
+		    fallbackDir (str): The flat model directory used if the registry
+		    				   has no current version
+		    featureMode (str, optional): Either "bow", "sow" or "tfidf", used
+		    							 for model versions without metadata
+		    batchSize (int, optional): Number of entries per micro-batch
+		    languageIds (Array.<str>, optional): Restrict to these languages
+		    probaCertainty (bool, optional): See Classifier.apply
+		    interval (float, optional): Seconds between two polls
+		    rescanInterval (float, optional): Seconds between two scans of
+		    								  all pending clean contents
+		    channel (str, optional): The notification channel, None to poll
+		    						 only
+		"""
+		super(Watcher, self).__init__()
+		self.logger = logging.getLogger("classifier.Watcher")
+		self.db = db
+		self.registry = registry
+		self.fallbackDir = fallbackDir
+		self.featureMode = featureMode
+		self.defaultFeatureMode = featureMode
+		self.batchSize = batchSize
+		self.languageIds = languageIds
+		self.probaCertainty = probaCertainty
+		self.interval = interval
+		self.rescanInterval = rescanInterval
+		self.channel = channel
+		self._modelDir = None
+		self._createdAfter = None
+		self._lastFullScan = None
+		self._stopped = False
+
+	def stop(self, *args):
+		"""Stop after the current micro-batch"""
+		self.logger.info("Stopping...")
+		self._stopped = True
+
+	def loadModels(self):
+		"""Load the current model version, unless it is already loaded
+
+		Returns:
+		    bool: True if a (new) version was loaded
+		"""
+		modelDir = self.registry.currentDirectory() or self.fallbackDir
+		if modelDir == self._modelDir:
+			return False
+		legalPath, labelPath, scalePath, reducePath, vocabularyPath, idfPath = artifactPaths(modelDir)
+		self.vocabulary = Vocabulary.restore(vocabularyPath, idfPath)
+		self.scaler = joblib.load(scalePath, mmap_mode="c")
+		self.reducer = joblib.load(reducePath, mmap_mode="c") if os.path.exists(reducePath) else None
+		self.labelClf = Classifier.fromModel(joblib.load(labelPath, mmap_mode="c"), "LabelClassifier")
+		self.legalClf = Classifier.fromModel(joblib.load(legalPath, mmap_mode="c"), "LegalClassifier")
+		self.featureMode = versionMetadata(modelDir).get("featureMode", self.defaultFeatureMode)
+		self._modelDir = modelDir
+		self.logger.info("Loaded models from {modelDir} (featureMode {featureMode})".format(
+			modelDir=modelDir,
+			featureMode=self.featureMode
+		))
+		return True
+
+	def labelPending(self):
+		"""Label the pending clean contents created since the previous cycle
+
+		The first cycle and one cycle every rescanInterval scan all pending
+		clean contents.
+
+		Returns:
+		    int: The number of labelled entries
+		"""
+		labelled = 0
+		start = time.time()
+		fullScan = self._lastFullScan is None or start - self._lastFullScan >= self.rescanInterval
+		latest = self.db.latestCreatedAt()
+		batches = self.db.iterLabellingData(
+			batchSize=self.batchSize,
+			mode=self.featureMode,
+			vocabulary=self.vocabulary,
+			languageIds=self.languageIds,
+			createdAfter=None if fullScan else self._createdAfter
+		)
+		for X, cleanContents in batches:
+			if len(cleanContents) == 0:
+				continue
+			X = self.scaler.transform(X)
+			if self.reducer is not None:
+				X = self.reducer.transform(X)
+			labels, labelCertainties = self.labelClf.apply(X, self.probaCertainty)
+			legals, legalCertainties = self.legalClf.apply(X, self.probaCertainty)
+			self.db.storeResults(list(zip(
+				[cleanContent.cleanContentId for cleanContent in cleanContents],
+				labels,
+				legals,
+				labelCertainties,
+				legalCertainties
+			)))
+			labelled += len(cleanContents)
+			if self._stopped:
+				# Not all pending entries seen - keep the high-water mark
+				return labelled
+		if fullScan:
+			self._lastFullScan = start
+		if latest is not None:
+			self._createdAfter = latest - HIGH_WATER_MARK_LAG
+		return labelled
+
+	def run(self):
+		"""Label pending clean contents until stopped (SIGTERM/SIGINT)
+
+		Returns:
+		    int: The total number of labelled entries
+		"""
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		connection = None
+		if self.channel is not None:
+			connection = self.db.listen(self.channel)
+			self.logger.info("Listening on channel {channel}".format(channel=self.channel))
+		total = 0
+		while not self._stopped:
+			self.loadModels()
+			start = time.time()
+			labelled = self.labelPending()
+			total += labelled
+			if labelled > 0:
+				self.logger.info("Labelled {count} entries in {seconds:.2f}s".format(
+					count=labelled,
+					seconds=time.time() - start
+				))
+			# Wake up at least every interval, also to catch a new model version
+			deadline = time.time() + self.interval
+			while not self._stopped and time.time() < deadline:
+				timeout = max(0, min(1, deadline - time.time()))
+				if connection is not None:
+					if self.db.waitForNotify(connection, timeout):
+						break
+				else:
+					time.sleep(timeout)
+		if connection is not None:
+			connection.close()
+		return total
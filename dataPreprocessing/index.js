@@ -17,6 +17,9 @@ let Parser = require("../server/app/parser");
 let sourceDb = require("../server/app/models");
 let targetDb = require("./models");
 let waitingForDbConnection = [];
+// Must match NOTIFY_CHANNEL of the classifier (classifier/start.py), which
+// labels new clean contents as soon as it is notified in serve mode
+const CLASSIFIER_NOTIFY_CHANNEL = "classifier";
 let limit = parseInt(process.env.PREPROCESSOR_MAX_POOL_SIZE, 10);
 let dbConnections = parseInt(process.env.PREPROCESSOR_MAX_PARALLEL, 10);
 if (isNaN(limit) || limit <= 0) {
@@ -142,6 +145,11 @@ const commandLineOptions = commandLineArgs([
  * used for machine learning
  */
 async function run() {
+    // See the indexes of the cleanContent model
+    await targetDb.sequelize.query(
+        "CREATE INDEX IF NOT EXISTS \"cleanContents_createdAt\" " +
+        "ON \"cleanContents\" (\"createdAt\")"
+    );
     // initialize: language table contains exactly 82 languages (the ones
     // supported by franc-min). They are inserted here and the keys are stored
     // in a mapping for later use.
@@ -407,6 +415,7 @@ async function storeResult(
     }
     let transaction = await targetDb.sequelize.transaction();
     let cleanContentInstance;
+    let created = false;
     if (!cleanContentModel) {
         try {
             cleanContentInstance = await targetDb.cleanContent.findOrCreate({
@@ -418,6 +427,7 @@ async function storeResult(
                 },
                 transaction: transaction,
             });
+            created = cleanContentInstance[1];
             cleanContentInstance = cleanContentInstance[0];
         } catch (e) {
             // statements
@@ -493,6 +503,32 @@ async function storeResult(
             finalErrorHandler(err, transaction);
         });
     }
+    if (!created) {
+        // The classifier's feature cache keys the vectors by updatedAt
+        await targetDb.sequelize.query(
+            "UPDATE \"cleanContents\" SET \"updatedAt\" = now() " +
+            "WHERE \"cleanContentId\" = ?",
+            {
+                replacements: [cleanContentInstance.cleanContentId],
+                transaction: transaction,
+            }
+        ).catch((err) => {
+            console.error("An error occured while updating a clean content");
+            console.error("This occured most likely due to a connection issue");
+            finalErrorHandler(err, transaction);
+        });
+    }
+    if (created) {
+        // Delivered on commit, i.e. once the postings are visible
+        await targetDb.sequelize.query(
+            "NOTIFY \"" + CLASSIFIER_NOTIFY_CHANNEL + "\"",
+            {transaction: transaction}
+        ).catch((err) => {
+            console.error("An error occured while notifying the classifier");
+            console.error("This occured most likely due to a connection issue");
+            finalErrorHandler(err, transaction);
+        });
+    }
     transaction.commit();
     return id;
 }
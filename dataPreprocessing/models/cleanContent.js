@@ -39,6 +39,13 @@ module.exports = (sequelize, DataTypes) => {
                     {attribute: "rawContentId", order: "DESC"},
                 ],
             },
+            {
+                // The classifier's serve mode only scans clean contents
+                // created since its previous cycle. Also created by run()
+                // in index.js for databases that are not synced
+                name: "cleanContents_createdAt",
+                fields: ["createdAt"],
+            },
         ],
     });
     CleanContent.associate = function(models) {